@@ -45,14 +45,99 @@ def routes():
         print(line)
 
 
-# @manager.command
-# def test():
-#     """Runs the unit tests."""
-#     tests = unittest.TestLoader().discover('app/test', pattern='test*.py')
-#     result = unittest.TextTestRunner(verbosity=2).run(tests)
-#     if result.wasSuccessful():
-#         return 0
-#     return 1
+@manager.command
+def retention():
+    """ Creates next record partitions and removes expired records """
+    from datetime import datetime
+    from wiim.api.services import retention_service
+
+    result = retention_service.apply(datetime.utcnow())
+
+    print('Created partitions: {}'.format(', '.join(result['created']) or '-'))
+    print('Dropped partitions: {}'.format(', '.join(result['dropped']) or '-'))
+    print('Deleted records: {}'.format(result['deleted']))
+
+
+@manager.option('-d', '--days', dest='days', type=int, default=1,
+                help='Days of history to rebuild')
+def rollup(days):
+    """ Rebuilds rollups of records history, one tag and day at a time """
+    from datetime import datetime, timedelta
+    from wiim.api.services import rollup_service, Tag
+
+    now = datetime.utcnow()
+
+    for tag_id, in db.session.query(Tag.id):
+        for day in range(days, 0, -1):
+            start = now - timedelta(days=day)
+            rollup_service.update([(tag_id, start), (tag_id, start + timedelta(days=1))])
+            db.session.commit()
+
+        print('Tag {} rollups rebuilt'.format(tag_id))
+
+
+@manager.option('-s', '--size', dest='size', type=int, default=None,
+                help='Records per bulk insert')
+@manager.option('-i', '--interval', dest='interval', type=float, default=None,
+                help='Maximum seconds between inserts')
+def collect(size, interval):
+    """ Collects data changes of OPC-UA tags into records until interrupted """
+    import logging
+    from wiim.collector import create_collector
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    create_collector(app, size, interval).run()
+
+
+@manager.command
+def explain():
+    """ Checks if records and timeline queries use indexes """
+    from wiim.api.services import record_service, timeline_service, Record
+
+    # tables too big to be full scanned
+    hot_tables = ('record', 'process_tags', 'tag_latest')
+    cursor = record_service.next_cursor([{'time_opc': '2018-01-01T00:00:00', 'id': 1}], 'desc')
+
+    queries = [
+        ('records', Record.query),
+        ('tag records', Record.query.filter_by(tag_id=1)),
+        ('tags records', record_service.query_by_tags([1, 2])),
+        ('process records', record_service.query_by_process(1)),
+        ('cursor records', record_service.after_cursor(Record.query.filter_by(tag_id=1), cursor)[0]),
+    ]
+    queries = [(name, record_service.filter_query(query, 100, order_by='desc'))
+               for name, query in queries]
+    queries.append(('timeline', timeline_service.timeline_query(1)))
+
+    scans = 0
+
+    for name, query in queries:
+        statement = query.with_labels().statement.compile(db.engine)
+        plan = db.engine.execute('EXPLAIN ' + statement.string, statement.params)
+
+        for row in plan:
+            row = dict(row.items())
+            scan = row['type'] == 'ALL' and row['table'] in hot_tables
+            scans += scan
+
+            print("{:16s} {:14s} {:8s} {:24s} {}".format(
+                name, str(row['table']), str(row['type']), str(row['key']),
+                'FULL SCAN' if scan else 'ok'))
+
+    return 1 if scans else 0
+
+
+@manager.command
+def test():
+    """ Runs the unit tests, against the database of TestingConfig """
+    import unittest
+
+    tests = unittest.TestLoader().discover('tests', pattern='test*.py', top_level_dir='.')
+    result = unittest.TextTestRunner(verbosity=2).run(tests)
+    if result.wasSuccessful():
+        return 0
+    return 1
 
 
 if __name__ == '__main__':
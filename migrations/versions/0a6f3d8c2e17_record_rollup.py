@@ -0,0 +1,37 @@
+"""record rollup
+
+Revision ID: 0a6f3d8c2e17
+Revises: e7a2c5d91b30
+Create Date: 2026-10-18 17:55:49.603271
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '0a6f3d8c2e17'
+down_revision = 'e7a2c5d91b30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('record_rollup',
+    sa.Column('tag_id', sa.Integer(), nullable=False),
+    sa.Column('resolution', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('bucket', mysql.DATETIME(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('sum', mysql.DOUBLE(), nullable=False),
+    sa.Column('min', mysql.DOUBLE(), nullable=False),
+    sa.Column('max', mysql.DOUBLE(), nullable=False),
+    sa.Column('first', mysql.DOUBLE(), nullable=False),
+    sa.Column('last', mysql.DOUBLE(), nullable=False),
+    sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('tag_id', 'resolution', 'bucket')
+    )
+
+
+def downgrade():
+    op.drop_table('record_rollup')
@@ -0,0 +1,28 @@
+"""record indexes
+
+Revision ID: 4b8c0f3e6a95
+Revises: 9d4e1b7a2f61
+Create Date: 2026-10-18 15:20:37.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b8c0f3e6a95'
+down_revision = '9d4e1b7a2f61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('idx_record__tag_time', 'record', ['tag_id', 'time_opc', 'id'], unique=False)
+    op.create_index('idx_record__time', 'record', ['time_opc'], unique=False)
+    op.create_index('idx_process_tags__tag', 'process_tags', ['tag_id', 'process_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_process_tags__tag', table_name='process_tags')
+    op.drop_index('idx_record__time', table_name='record')
+    op.drop_index('idx_record__tag_time', table_name='record')
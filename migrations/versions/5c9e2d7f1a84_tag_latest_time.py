@@ -0,0 +1,35 @@
+"""tag latest record time
+
+Revision ID: 5c9e2d7f1a84
+Revises: d7b3f4a9e216
+Create Date: 2026-10-19 10:12:48.503217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '5c9e2d7f1a84'
+down_revision = 'd7b3f4a9e216'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tag_latest', sa.Column('time_opc', mysql.DATETIME(fsp=3), nullable=True))
+
+    # time of existing last records
+    op.execute(
+        'UPDATE tag_latest JOIN record ON record.id = tag_latest.record_id '
+        'SET tag_latest.time_opc = record.time_opc'
+    )
+    op.execute('DELETE FROM tag_latest WHERE time_opc IS NULL')
+
+    op.alter_column('tag_latest', 'time_opc', existing_type=mysql.DATETIME(fsp=3),
+                    nullable=False)
+
+
+def downgrade():
+    op.drop_column('tag_latest', 'time_opc')
@@ -0,0 +1,32 @@
+"""rollup pending spans
+
+Revision ID: 8e2f5a7c3d19
+Revises: 5c9e2d7f1a84
+Create Date: 2026-10-20 09:41:27.162804
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2f5a7c3d19'
+down_revision = '5c9e2d7f1a84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rollup_pending',
+    sa.Column('tag_id', sa.Integer(), nullable=False),
+    sa.Column('time_start', mysql.DATETIME(fsp=3), nullable=False),
+    sa.Column('time_end', mysql.DATETIME(fsp=3), nullable=False),
+    sa.Column('version', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('tag_id')
+    )
+
+
+def downgrade():
+    op.drop_table('rollup_pending')
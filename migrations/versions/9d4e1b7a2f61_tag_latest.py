@@ -0,0 +1,34 @@
+"""tag latest record
+
+Revision ID: 9d4e1b7a2f61
+Revises: c3a64599ae08
+Create Date: 2026-10-18 14:02:11.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4e1b7a2f61'
+down_revision = 'c3a64599ae08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('tag_latest',
+    sa.Column('tag_id', sa.Integer(), nullable=False),
+    sa.Column('record_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('tag_id')
+    )
+    # fill with last record of existing history
+    op.execute(
+        'INSERT INTO tag_latest (tag_id, record_id) '
+        'SELECT tag_id, MAX(id) FROM record GROUP BY tag_id'
+    )
+
+
+def downgrade():
+    op.drop_table('tag_latest')
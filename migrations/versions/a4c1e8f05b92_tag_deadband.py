@@ -0,0 +1,29 @@
+"""tag deadband and heartbeat
+
+Revision ID: a4c1e8f05b92
+Revises: f2d86b4a1c53
+Create Date: 2026-10-18 22:31:08.604719
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c1e8f05b92'
+down_revision = 'f2d86b4a1c53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tag', sa.Column('deadband', mysql.DOUBLE(asdecimal=False), nullable=True))
+    op.add_column('tag', sa.Column('deadband_type', sa.String(length=8), server_default='absolute', nullable=False))
+    op.add_column('tag', sa.Column('heartbeat', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tag', 'heartbeat')
+    op.drop_column('tag', 'deadband_type')
+    op.drop_column('tag', 'deadband')
@@ -0,0 +1,75 @@
+"""typed record values
+
+Revision ID: b51e9a0c7d48
+Revises: 0a6f3d8c2e17
+Create Date: 2026-10-18 19:12:26.734880
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b51e9a0c7d48'
+down_revision = '0a6f3d8c2e17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tag', sa.Column('data_type', sa.String(length=8), server_default='double', nullable=False))
+    op.add_column('record', sa.Column('value_double', mysql.DOUBLE(asdecimal=False), nullable=True))
+    op.add_column('record', sa.Column('value_int', sa.BigInteger(), nullable=True))
+    op.add_column('record', sa.Column('value_bool', sa.Boolean(), nullable=True))
+    op.add_column('record', sa.Column('value_text', sa.String(length=120), nullable=True))
+    op.add_column('record', sa.Column('quality_code', sa.SmallInteger(), nullable=True))
+
+    # numeric values as double, tags with any other value as string
+    op.execute(
+        "UPDATE record SET value_double = value + 0 "
+        "WHERE value REGEXP '^[-+]?[0-9]*[.]?[0-9]+([eE][-+]?[0-9]+)?$'"
+    )
+    op.execute(
+        "UPDATE tag SET data_type = 'string' WHERE id IN "
+        "(SELECT tag_id FROM (SELECT DISTINCT tag_id FROM record "
+        "WHERE value_double IS NULL) AS t)"
+    )
+    op.execute(
+        "UPDATE record JOIN tag ON tag.id = record.tag_id "
+        "SET record.value_text = record.value, record.value_double = NULL "
+        "WHERE tag.data_type = 'string'"
+    )
+    # quality names to status codes
+    op.execute(
+        "UPDATE record SET quality_code = CASE "
+        "WHEN quality LIKE '%Good%' THEN 0 "
+        "WHEN quality LIKE '%Uncertain%' THEN 1 "
+        "ELSE 2 END"
+    )
+
+    op.drop_column('record', 'value')
+    op.drop_column('record', 'quality')
+    op.alter_column('record', 'quality_code', new_column_name='quality',
+                    existing_type=sa.SmallInteger(), nullable=False)
+
+
+def downgrade():
+    op.add_column('record', sa.Column('value', sa.String(length=120), nullable=True))
+    op.alter_column('record', 'quality', new_column_name='quality_code',
+                    existing_type=sa.SmallInteger(), nullable=True)
+    op.add_column('record', sa.Column('quality', sa.String(length=64), nullable=True))
+
+    op.execute(
+        "UPDATE record SET value = COALESCE(value_double, value_int, value_bool, value_text), "
+        "quality = ELT(quality_code + 1, 'Good', 'Uncertain', 'Bad')"
+    )
+
+    op.alter_column('record', 'value', existing_type=sa.String(length=120), nullable=False)
+    op.alter_column('record', 'quality', existing_type=sa.String(length=64), nullable=False)
+    op.drop_column('record', 'quality_code')
+    op.drop_column('record', 'value_text')
+    op.drop_column('record', 'value_bool')
+    op.drop_column('record', 'value_int')
+    op.drop_column('record', 'value_double')
+    op.drop_column('tag', 'data_type')
@@ -0,0 +1,25 @@
+"""tag compression
+
+Revision ID: d7b3f4a9e216
+Revises: a4c1e8f05b92
+Create Date: 2026-10-18 23:40:17.281946
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7b3f4a9e216'
+down_revision = 'a4c1e8f05b92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tag', sa.Column('compression', mysql.DOUBLE(asdecimal=False), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tag', 'compression')
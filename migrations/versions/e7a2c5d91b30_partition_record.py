@@ -0,0 +1,53 @@
+"""partition record and retention
+
+Revision ID: e7a2c5d91b30
+Revises: 4b8c0f3e6a95
+Create Date: 2026-10-18 16:41:05.227930
+
+"""
+from datetime import datetime, timedelta
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2c5d91b30'
+down_revision = '4b8c0f3e6a95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('server', sa.Column('retention', sa.Integer(), nullable=True))
+    op.add_column('tag', sa.Column('retention', sa.Integer(), nullable=True))
+
+    # row locks instead of table locks
+    op.execute('ALTER TABLE record ENGINE = InnoDB')
+    # partition column must be part of every unique key
+    op.execute('ALTER TABLE record DROP PRIMARY KEY, ADD PRIMARY KEY (id, time_opc)')
+
+    # monthly partitions from first record up to next month
+    first = op.get_bind().execute('SELECT MIN(time_opc) FROM record').scalar()
+    bound = (first or datetime.utcnow()).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+    until = datetime.utcnow() + timedelta(days=31)
+
+    partitions = []
+    while bound <= until:
+        name = bound.strftime('p%Y%m')
+        bound = (bound + timedelta(days=32)).replace(day=1)
+        partitions.append("PARTITION {} VALUES LESS THAN ('{:%Y-%m-%d %H:%M:%S}')".format(
+            name, bound))
+
+    partitions.append('PARTITION pmax VALUES LESS THAN (MAXVALUE)')
+    op.execute('ALTER TABLE record PARTITION BY RANGE COLUMNS(time_opc) ({})'.format(
+        ', '.join(partitions)))
+
+
+def downgrade():
+    op.execute('ALTER TABLE record REMOVE PARTITIONING')
+    op.execute('ALTER TABLE record DROP PRIMARY KEY, ADD PRIMARY KEY (id)')
+    op.execute('ALTER TABLE record ENGINE = MyISAM')
+
+    op.drop_column('tag', 'retention')
+    op.drop_column('server', 'retention')
@@ -0,0 +1,26 @@
+"""collector endpoints and nodes
+
+Revision ID: f2d86b4a1c53
+Revises: b51e9a0c7d48
+Create Date: 2026-10-18 21:06:42.153027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2d86b4a1c53'
+down_revision = 'b51e9a0c7d48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('server', sa.Column('endpoint', sa.String(length=255), nullable=True))
+    op.add_column('tag', sa.Column('node_id', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tag', 'node_id')
+    op.drop_column('server', 'endpoint')
@@ -0,0 +1,39 @@
+"""
+tests
+
+Tests of API and collector, run by manage.py test against the database of
+TestingConfig, skipped when it's unavailable
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import unittest
+from sqlalchemy.exc import OperationalError
+from wiim import create_app
+from wiim.api import db
+
+
+class AppTestCase(unittest.TestCase):
+    """ Test case with application context and empty tables """
+
+    config = 'wiim.settings.TestingConfig'
+
+    def setUp(self):
+        self.app = create_app(self.config)
+        self.context = self.app.app_context()
+        self.context.push()
+
+        try:
+            db.drop_all()
+            db.create_all()
+        except OperationalError as error:
+            self.context.pop()
+            raise unittest.SkipTest('Test database unavailable: {}'.format(error.orig))
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
@@ -0,0 +1,95 @@
+"""
+tests.test_api
+
+Tests of API endpoints
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+from datetime import datetime, timedelta
+from wiim.api.models import db, Site, Zone, Process, Server, Tag, Record
+from . import AppTestCase
+
+
+class RecordPaginationTest(AppTestCase):
+    """ Records paged with continuation tokens """
+
+    def setUp(self):
+        super(RecordPaginationTest, self).setUp()
+
+        server = Server(uid='test')
+        tags = [Tag(name='tag', alias='tag', server=server) for _ in range(2)]
+        other = Tag(name='other', alias='other', server=server)
+        process = Process(name='process', zone=Zone(name='zone', comment='',
+                          site=Site(name='site', comment='')), tags=tags)
+        db.session.add_all([server, other, process])
+
+        now = datetime.utcnow().replace(microsecond=0)
+        for i in range(7):
+            for tag in tags + [other]:
+                db.session.add(Record(tag=tag, time_opc=now + timedelta(seconds=i),
+                                      time_db=now, value_double=float(i), quality=0))
+
+        db.session.commit()
+        self.process_id = process.id
+        self.tag_ids = {tag.id for tag in tags}
+
+    def pages(self, url, order, limit=10):
+        """ Records of all pages of url, following X-Next-Cursor """
+        records = []
+        response = self.client.get('{}?count=3&order={}'.format(url, order))
+
+        for _ in range(limit):
+            self.assertEqual(response.status_code, 200, response.data)
+            page = response.get_json()
+            if not page:
+                return records
+
+            records.extend(page)
+            cursor = response.headers['X-Next-Cursor']
+            response = self.client.get('{}?count=3&cursor={}'.format(url, cursor))
+
+        self.fail('More than {} pages'.format(limit))
+
+    def test_process_records(self):
+        url = '/api/v1/processes/{}/records'.format(self.process_id)
+
+        for order in ('asc', 'desc'):
+            records = self.pages(url, order)
+            keys = [(r['time_opc'], r['id']) for r in records]
+
+            self.assertEqual(len(records), 14)
+            self.assertEqual(len(set(keys)), 14)
+            self.assertEqual(keys, sorted(keys, reverse=order == 'desc'))
+            self.assertEqual({r['tag'] for r in records}, self.tag_ids)
+
+
+class ConditionalTest(AppTestCase):
+    """ Validators of records views """
+
+    def setUp(self):
+        super(ConditionalTest, self).setUp()
+
+        tag = Tag(name='tag', alias='tag', server=Server(uid='test'))
+        now = datetime.utcnow().replace(microsecond=0)
+        db.session.add(Record(tag=tag, time_opc=now, time_db=now, value_double=1.0,
+                              quality=0))
+        db.session.commit()
+        self.url = '/api/v1/tags/{}/records'.format(tag.id)
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.headers.get('ETag'))
+
+        response = self.client.get(self.url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_rollups_without_validators(self):
+        # rollups are updated after records, validators of records would be stale
+        response = self.client.get(self.url + '?resolution=1m')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.headers.get('ETag'))
+        self.assertIsNone(response.headers.get('Last-Modified'))
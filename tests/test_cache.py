@@ -0,0 +1,53 @@
+"""
+tests.test_cache
+
+Tests of cached views versions on a shared cache
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import unittest
+from wiim import create_app
+from wiim.settings import TestingConfig
+from wiim.api.services import cache_versions, invalidate, version_time
+
+
+class RedisVersionsTest(unittest.TestCase):
+    """ Versions of tables on redis backend, with fakeredis client """
+
+    def setUp(self):
+        try:
+            import fakeredis
+        except ImportError:
+            raise unittest.SkipTest('fakeredis not installed')
+
+        class Config(TestingConfig):
+            CACHE_TYPE = 'redis'
+            # client used as host when there is no url
+            CACHE_REDIS_URL = None
+            CACHE_REDIS_HOST = fakeredis.FakeStrictRedis()
+
+        self.app = create_app(Config)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_start_versions(self):
+        versions = cache_versions(['site', 'zone'])
+
+        self.assertNotIn(None, versions)
+        self.assertNotEqual(versions[0], versions[1])
+        # kept for next reads
+        self.assertEqual(cache_versions(['site', 'zone']), versions)
+        for version in versions:
+            version_time(version)
+
+    def test_invalidate(self):
+        site, zone = cache_versions(['site', 'zone'])
+        invalidate(['site'])
+
+        self.assertNotEqual(cache_versions(['site'])[0], site)
+        self.assertEqual(cache_versions(['zone'])[0], zone)
@@ -0,0 +1,232 @@
+"""
+tests.test_collector
+
+Tests of collector records and writer, and of asyncio collector against a
+local OPC-UA server
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import socket
+import asyncio
+import unittest
+from datetime import datetime
+from time import monotonic
+from unittest import mock
+from sqlalchemy.exc import IntegrityError, OperationalError
+from wiim import create_app
+from wiim.api.models import db, Server, Tag, Record
+from wiim.collector import create_collector
+from wiim.collector.base import to_record
+from wiim.collector.writer import RecordWriter
+from . import AppTestCase
+
+
+def free_port():
+    """ Get a port no one is listening """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class AsyncCollectorTest(AppTestCase):
+    """ Records of data changes, also after the server restarts """
+
+    def setUp(self):
+        try:
+            import asyncua
+        except ImportError:
+            raise unittest.SkipTest('asyncua not installed')
+
+        super(AsyncCollectorTest, self).setUp()
+
+        self.app.config.update(
+            WIIM_COLLECT_ENGINE='asyncio',
+            WIIM_COLLECT_PUBLISH_INTERVAL=50,
+            WIIM_COLLECT_CHECK_INTERVAL=0.5,
+            WIIM_COLLECT_RECONNECT_MAX=1,
+        )
+        self.endpoint = 'opc.tcp://127.0.0.1:{}/'.format(free_port())
+
+        server = Server(uid='test', endpoint=self.endpoint)
+        tag = Tag(name='level', alias='level', node_id='ns=2;s=Level', server=server)
+        db.session.add_all([server, tag])
+        db.session.commit()
+        self.tag_id = tag.id
+
+    async def start_server(self):
+        """ Start OPC-UA server with the variable of tag """
+        from asyncua import Server as OpcServer, ua
+
+        server = OpcServer()
+        await server.init()
+        server.set_endpoint(self.endpoint)
+        await server.register_namespace('wiim')
+        folder = await server.nodes.objects.add_object(ua.NodeId('Plant', 2), 'Plant')
+        variable = await folder.add_variable(ua.NodeId('Level', 2), 'Level', 0.0)
+        await server.start()
+
+        return server, variable
+
+    async def wait_written(self, collector, count, timeout=15):
+        """ Wait until count records are written, failing after timeout seconds """
+        deadline = monotonic() + timeout
+
+        while collector.writer.written < count:
+            if monotonic() > deadline:
+                self.fail('{} of {} records written after {} seconds'.format(
+                    collector.writer.written, count, timeout))
+            await asyncio.sleep(0.05)
+
+    async def collect(self):
+        server, variable = await self.start_server()
+
+        collector = create_collector(self.app, size=1, interval=0.1)
+        collector.load()
+        stopping = asyncio.Event()
+        task = asyncio.ensure_future(collector.main(stopping))
+
+        try:
+            # initial value of subscription, then each change
+            await self.wait_written(collector, 1)
+            for count, value in enumerate((1.0, 2.0, 3.0), 2):
+                await variable.write_value(value)
+                await self.wait_written(collector, count)
+
+            # session is lost, collector reconnects and subscribes again
+            await server.stop()
+            server, variable = await self.start_server()
+            await self.wait_written(collector, 5)
+
+            await variable.write_value(42.0)
+            await self.wait_written(collector, 6)
+        finally:
+            stopping.set()
+            await task
+            await server.stop()
+
+    def values(self):
+        """ Values of tag records in insert order """
+        db.session.remove()
+        query = Record.query.filter_by(tag_id=self.tag_id).order_by(Record.id)
+
+        return [record.value for record in query]
+
+    def test_collect_and_resubscribe(self):
+        asyncio.run(self.collect())
+
+        values = self.values()
+        self.assertEqual(values[:4], [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(values[-1], 42.0)
+
+
+class RecordTest(unittest.TestCase):
+    """ Records from OPC-UA data values """
+
+    def setUp(self):
+        try:
+            from asyncua import ua
+        except ImportError:
+            raise unittest.SkipTest('asyncua not installed')
+
+        self.ua = ua
+
+    def data_value(self, value, status=0, **kwargs):
+        ua = self.ua
+        return ua.DataValue(ua.Variant(value), StatusCode=ua.StatusCode(status), **kwargs)
+
+    def test_record(self):
+        data_value = self.data_value(1.5, SourceTimestamp=datetime(2018, 1, 1, 0, 0, 0, 123456),
+                                     ServerTimestamp=datetime(2018, 1, 1, 0, 0, 1))
+
+        self.assertEqual(to_record(7, data_value), {
+            'tag_id': 7,
+            'time_opc': '2018-01-01T00:00:00.123',
+            'value': 1.5,
+            'quality': 'Good',
+        })
+
+    def test_server_timestamp(self):
+        data_value = self.data_value(True, ServerTimestamp=datetime(2018, 1, 1, 0, 0, 1))
+
+        self.assertEqual(to_record(7, data_value)['time_opc'], '2018-01-01T00:00:01.000')
+
+    def test_quality(self):
+        codes = self.ua.StatusCodes
+        statuses = [(codes.GoodClamped, 'Good'), (codes.UncertainLastUsableValue, 'Uncertain'),
+                    (codes.BadCommunicationError, 'Bad'), (0xC0000000, 'Bad')]
+
+        for status, quality in statuses:
+            self.assertEqual(to_record(7, self.data_value(1, status))['quality'], quality)
+
+    def test_no_value(self):
+        self.assertIsNone(to_record(7, self.data_value(None)))
+
+
+class WriterTest(unittest.TestCase):
+    """ Batches split until the records failing them are rejected alone """
+
+    def setUp(self):
+        self.app = create_app('wiim.settings.TestingConfig')
+        self.writer = RecordWriter(self.app, size=8)
+        self.inserts = []
+
+        patcher = mock.patch('wiim.collector.writer.record_service')
+        self.record_service = patcher.start()
+        self.record_service.create_many.side_effect = self.create_many
+        self.addCleanup(patcher.stop)
+
+    def create_many(self, records, dedupe=False):
+        """ Insert failing with records without value, like a database constraint """
+        self.inserts.append([r['tag_id'] for r in records])
+        if any(r['value'] is None for r in records):
+            raise IntegrityError('INSERT', {}, Exception('value cannot be null'))
+
+        return {'created': len(records), 'duplicates': 0, 'errors': []}
+
+    def records(self, invalid=()):
+        return [{'tag_id': i, 'time_opc': '2018-01-01T00:00:00.000', 'quality': 'Good',
+                 'value': None if i in invalid else 1.0} for i in range(8)]
+
+    def test_batch(self):
+        self.assertEqual(self.writer.write(self.records()), 8)
+        self.assertEqual(self.inserts, [list(range(8))])
+        self.assertEqual((self.writer.written, self.writer.dropped), (8, 0))
+
+    def test_split_batch(self):
+        self.assertEqual(self.writer.write(self.records(invalid=(2, 5))), 8)
+
+        self.assertEqual(self.inserts, [
+            [0, 1, 2, 3, 4, 5, 6, 7],
+            [0, 1, 2, 3], [0, 1], [2, 3], [2], [3],
+            [4, 5, 6, 7], [4, 5], [4], [5], [6, 7],
+        ])
+        self.assertEqual((self.writer.written, self.writer.dropped), (6, 2))
+
+    def test_validation_errors(self):
+        self.record_service.create_many.side_effect = None
+        self.record_service.create_many.return_value = {
+            'created': 7, 'duplicates': 0, 'errors': [{'index': 3, 'messages': {}}]}
+
+        self.assertEqual(self.writer.write(self.records()), 8)
+        self.assertEqual((self.writer.written, self.writer.dropped), (7, 1))
+
+    def test_database_unavailable(self):
+        self.record_service.create_many.side_effect = OperationalError(
+            'INSERT', {}, Exception('server has gone away'))
+
+        self.assertEqual(self.writer.write(self.records()), 0)
+        self.assertEqual((self.writer.written, self.writer.dropped), (0, 0))
+
+    def test_unavailable_after_split(self):
+        def create_many(records, dedupe=False):
+            if len(records) < 8 and records[0]['tag_id'] >= 4:
+                raise OperationalError('INSERT', {}, Exception('server has gone away'))
+            return self.create_many(records, dedupe)
+
+        self.record_service.create_many.side_effect = create_many
+
+        # records before the failing half are handled, the rest retried later
+        self.assertEqual(self.writer.write(self.records(invalid=(2,))), 4)
+        self.assertEqual((self.writer.written, self.writer.dropped), (3, 1))
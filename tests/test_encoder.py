@@ -0,0 +1,57 @@
+"""
+tests.test_encoder
+
+Tests of JSON libraries output
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import unittest
+from datetime import datetime
+from flask import Flask
+from wiim.encoder import ENCODERS, JSONProvider
+
+DATA = {
+    1: 'key not string',
+    'url': 'http://localhost/api/v1/tags',
+    'text': 'çãé \U0001F600',
+    'values': [1, 1.1, 0.1 + 0.2, 1e20, True, None],
+    'time': datetime(2018, 1, 1, 12, 30, 15, 4500),
+}
+
+
+class EncoderTest(unittest.TestCase):
+    """ Same JSON text with every library """
+
+    def dumps(self, name, **config):
+        app = Flask(__name__)
+        app.config.update(WIIM_JSON_ENCODER=name, WIIM_JSON_COMPACT=None,
+                          JSON_SORT_KEYS=False, **config)
+
+        try:
+            return JSONProvider(app).dumps(DATA)
+        except ImportError:
+            return None
+
+    def assertSameOutput(self, **config):
+        outputs = {name: self.dumps(name, **config) for name in ENCODERS}
+        expected = outputs.pop('json')
+
+        for name, output in outputs.items():
+            if output is not None:
+                self.assertEqual(output, expected, name)
+
+    def test_compact(self):
+        self.assertSameOutput()
+        self.assertSameOutput(JSON_AS_ASCII=False)
+
+    def test_pretty(self):
+        self.assertSameOutput(JSONIFY_PRETTYPRINT_REGULAR=True)
+
+    def test_sort_keys(self):
+        app = Flask(__name__)
+        app.config.update(WIIM_JSON_ENCODER=None, WIIM_JSON_COMPACT=True)
+        data = {'b': 1, 'a': {'d': 2, 'c': 3}}
+
+        self.assertEqual(JSONProvider(app).dumps(data), '{"a":{"c":3,"d":2},"b":1}')
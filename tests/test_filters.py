@@ -0,0 +1,206 @@
+"""
+tests.test_filters
+
+Tests of collector deadband, heartbeat and compression filters
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+from wiim.collector.filters import SwingingDoor, TagFilter, deadband_groups
+
+START = datetime(2018, 1, 1)
+
+
+def record(second, value, quality='Good'):
+    time = START + timedelta(seconds=second)
+    return {'tag_id': 1, 'time_opc': time.isoformat(timespec='microseconds'),
+            'value': value, 'quality': quality}
+
+
+def values(records):
+    return [r['value'] for r in records]
+
+
+class SwingingDoorTest(unittest.TestCase):
+    """ Records stored only at turning points of the signal """
+
+    def add_all(self, door, records):
+        return [stored for r in records for stored in door.add(r)]
+
+    def test_line(self):
+        door = SwingingDoor(0.5)
+        stored = self.add_all(door, [record(i, float(i)) for i in range(10)])
+
+        self.assertEqual(values(stored), [0.0])
+        self.assertEqual(values(door.flush()), [9.0])
+        self.assertEqual(door.flush(), [])
+
+    def test_turning_point(self):
+        door = SwingingDoor(0.5)
+        signal = [0.0, 1.0, 2.0, 3.0, 2.0, 1.0]
+        stored = self.add_all(door, [record(i, value) for i, value in enumerate(signal)])
+
+        self.assertEqual(values(stored + door.flush()), [0.0, 3.0, 1.0])
+
+    def test_within_deviation(self):
+        door = SwingingDoor(0.5)
+        signal = [0.0, 0.2, -0.2, 0.3, 0.0]
+        stored = self.add_all(door, [record(i, value) for i, value in enumerate(signal)])
+
+        self.assertEqual(values(stored + door.flush()), [0.0, 0.0])
+
+    def test_max_gap(self):
+        door = SwingingDoor(0.5, max_gap=5)
+        stored = self.add_all(door, [record(i, 1.0) for i in range(0, 14, 2)])
+
+        self.assertEqual([r['time_opc'][17:19] for r in stored], ['00', '04', '08'])
+
+    def test_quality_change(self):
+        door = SwingingDoor(0.5)
+        records = [record(0, 1.0), record(1, 1.0), record(2, 1.0, 'Bad')]
+
+        self.assertEqual(self.add_all(door, records), [records[0], records[1], records[2]])
+        self.assertEqual(door.flush(), [])
+
+    def test_not_number(self):
+        door = SwingingDoor(0.5)
+        records = [record(0, 'on'), record(1, 'off')]
+
+        self.assertEqual(self.add_all(door, records), records)
+
+    def test_same_time_as_held(self):
+        door = SwingingDoor(0.5)
+        records = [record(0, 0.0), record(1, 0.0), record(1, 10.0)]
+
+        self.assertEqual(self.add_all(door, records), records)
+        self.assertEqual(door.flush(), [])
+
+        # continues from last stored
+        self.assertEqual(door.add(record(2, 10.0)), [])
+        self.assertEqual(values(door.flush()), [10.0])
+
+    def test_older_than_stored(self):
+        door = SwingingDoor(0.5)
+        records = [record(5, 0.0), record(5, 1.0), record(4, 2.0)]
+
+        self.assertEqual(self.add_all(door, records), records)
+
+
+class TagFilterTest(unittest.TestCase):
+    """ Values passed by deadband and heartbeat """
+
+    def setUp(self):
+        self.now = 0.0
+        patcher = mock.patch('wiim.collector.filters.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def filter_all(self, tag_filter, signal):
+        return values([stored for i, value in enumerate(signal)
+                       for stored in tag_filter.filter(record(i, value))])
+
+    def test_no_deadband(self):
+        tag_filter = TagFilter(1)
+
+        self.assertEqual(self.filter_all(tag_filter, [1.0, 1.0, 1.5, 'on', 'on']),
+                         [1.0, 1.5, 'on'])
+
+    def test_absolute_deadband(self):
+        tag_filter = TagFilter(1, deadband=1.0)
+
+        self.assertEqual(self.filter_all(tag_filter, [0.0, 0.5, 1.0, 1.5, 3.0, 2.5]),
+                         [0.0, 1.5, 3.0])
+
+    def test_quality_change(self):
+        tag_filter = TagFilter(1, deadband=1.0)
+        tag_filter.filter(record(0, 0.0))
+
+        self.assertEqual(tag_filter.filter(record(1, 0.0, 'Bad')), [record(1, 0.0, 'Bad')])
+
+    def test_percent_deadband_span(self):
+        tag_filter = TagFilter(1, deadband=10, percent=True)
+        tag_filter.span = 50.0
+
+        self.assertEqual(self.filter_all(tag_filter, [100.0, 104.0, 106.0]), [100.0, 106.0])
+
+    def test_percent_deadband_without_span(self):
+        tag_filter = TagFilter(1, deadband=10, percent=True)
+
+        # relative to last passed value
+        self.assertEqual(self.filter_all(tag_filter, [100.0, 109.0, 111.0, 120.0, 123.0]),
+                         [100.0, 111.0, 123.0])
+
+    def test_heartbeat_filter(self):
+        tag_filter = TagFilter(1, deadband=1.0, heartbeat=10)
+        tag_filter.filter(record(0, 0.0))
+
+        self.now = 5
+        self.assertEqual(tag_filter.filter(record(5, 0.1)), [])
+
+        # passes when due, even without change
+        self.now = 10
+        self.assertEqual(values(tag_filter.filter(record(10, 0.2))), [0.2])
+
+    def test_heartbeat_beat(self):
+        tag_filter = TagFilter(1, heartbeat=10)
+        self.assertEqual(tag_filter.beat(), [])
+
+        tag_filter.filter(record(0, 1.0))
+        self.now = 5
+        self.assertEqual(tag_filter.beat(), [])
+
+        # last stored repeated at current time
+        self.now = 10
+        beat = tag_filter.beat()
+        self.assertEqual(values(beat), [1.0])
+        self.assertNotEqual(beat[0]['time_opc'], record(0, 1.0)['time_opc'])
+
+        self.now = 15
+        self.assertEqual(tag_filter.beat(), [])
+
+    def test_compression_beat_flushes_held(self):
+        tag_filter = TagFilter(1, heartbeat=10, compression=0.5)
+        self.assertEqual(self.filter_all(tag_filter, [0.0, 1.0, 2.0]), [0.0])
+
+        self.now = 10
+        self.assertEqual(values(tag_filter.beat()), [2.0])
+
+    def test_compression_keeps_skipped(self):
+        tag_filter = TagFilter(1, deadband=1.0, compression=0.5)
+
+        # flat segment ends at last skipped value, before the step
+        self.assertEqual(self.filter_all(tag_filter, [0.0, 0.1, 0.2, 5.0]) +
+                         values(tag_filter.flush()), [0.0, 0.2, 5.0])
+
+    def test_flush(self):
+        self.assertEqual(TagFilter(1, deadband=1.0).flush(), [])
+
+        tag_filter = TagFilter(1, compression=0.5)
+        self.filter_all(tag_filter, [0.0, 1.0, 2.0])
+        self.assertEqual(values(tag_filter.flush()), [2.0])
+        self.assertEqual(tag_filter.flush(), [])
+
+
+class DeadbandGroupsTest(unittest.TestCase):
+    """ Nodes grouped by data change filter of their monitored items """
+
+    def test_groups(self):
+        filters = {
+            'a': TagFilter(1, deadband=0.5),
+            'b': TagFilter(2, deadband=2.0, percent=True),
+            'c': TagFilter(3, deadband=0.5),
+            'd': TagFilter(4, deadband=0.5, percent=True),
+            'e': TagFilter(5),
+            'f': TagFilter(6, deadband=0, percent=True),
+        }
+
+        self.assertEqual(deadband_groups(filters), {
+            (0.5, 1): ['a', 'c'],
+            (2.0, 2): ['b'],
+            (0.5, 2): ['d'],
+            None: ['e', 'f'],
+        })
@@ -0,0 +1,115 @@
+"""
+tests.test_services
+
+Tests of API services
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+from datetime import datetime, timedelta
+from flask_sqlalchemy import get_debug_queries
+from wiim.api.models import db, Site, Zone, Process, Server, Tag, Record, Rollup, \
+    RollupPending
+from wiim.api.services import site_service, zone_service, process_service, \
+    server_service, tag_service, record_service, rollup_service
+from . import AppTestCase
+
+
+class EagerLoadTest(AppTestCase):
+    """ List services run a constant number of queries, whatever the rows """
+
+    def add_rows(self, count):
+        """ Add count rows of each model, related to each other """
+        now = datetime.utcnow()
+
+        for i in range(count):
+            site = Site(name='site', comment='')
+            zone = Zone(name='zone', comment='', site=site)
+            server = Server(uid='opc.tcp://localhost:{}'.format(4840 + i))
+            tag = Tag(name='tag', alias='tag', server=server)
+            process = Process(name='process', zone=zone, tags=[tag])
+            record = Record(tag=tag, time_opc=now + timedelta(seconds=i), time_db=now,
+                            value_double=float(i), quality=0)
+            db.session.add_all([site, zone, server, tag, process, record])
+
+        db.session.commit()
+
+    def count_queries(self, get):
+        """ Queries run by get, with relationships dumped, in a request """
+        with self.app.test_request_context():
+            start = len(get_debug_queries())
+            result = get()
+            self.assertTrue(result)
+
+            return len(get_debug_queries()) - start
+
+    def test_constant_queries(self):
+        services = [site_service, zone_service, process_service, server_service,
+                    tag_service, record_service]
+
+        self.add_rows(2)
+        few = [self.count_queries(service.get_all) for service in services]
+
+        self.add_rows(20)
+        many = [self.count_queries(service.get_all) for service in services]
+
+        self.assertEqual(few, many)
+        # query of rows and one per eager loaded collection
+        for service, count in zip(services, many):
+            self.assertLessEqual(count, 2, service.Model.__name__)
+
+
+class RollupPendingTest(AppTestCase):
+    """ Deferred rollups kept in database until updated """
+
+    def setUp(self):
+        super(RollupPendingTest, self).setUp()
+        self.app.config['WIIM_ROLLUP_INTERVAL'] = 3600
+
+        tag = Tag(name='tag', alias='tag', server=Server(uid='test'))
+        db.session.add(tag)
+        db.session.commit()
+        self.tag_id = tag.id
+
+    def create(self, time_opc, value):
+        with self.app.test_request_context():
+            record_service.create(tag_id=self.tag_id, time_opc=time_opc, value=value,
+                                  quality='Good')
+
+    def test_update_pending(self):
+        self.create('2018-01-01T00:00:10', 1.0)
+        self.create('2018-01-01T00:01:10', 3.0)
+        self.create('2018-01-01T00:00:20', 2.0)
+
+        # span saved with records, rollups not computed yet
+        pending = RollupPending.query.get(self.tag_id)
+        self.assertEqual((pending.time_start, pending.time_end),
+                         (datetime(2018, 1, 1, 0, 0, 10), datetime(2018, 1, 1, 0, 1, 10)))
+        self.assertEqual(Rollup.query.count(), 0)
+
+        self.assertEqual(rollup_service.update_pending(), 1)
+        self.assertIsNone(RollupPending.query.get(self.tag_id))
+
+        minutes = Rollup.query.filter_by(resolution=60).order_by(Rollup.bucket).all()
+        self.assertEqual([(r.count, r.first, r.last) for r in minutes],
+                         [(2, 1.0, 2.0), (1, 3.0, 3.0)])
+        self.assertEqual(rollup_service.update_pending(), 0)
+
+    def test_keep_extended_span(self):
+        self.create('2018-01-01T00:00:10', 1.0)
+        update_spans = rollup_service.update_spans
+
+        def extend(spans):
+            # records of another request inserted while updating
+            update_spans(spans)
+            rollup_service.defer([(self.tag_id, datetime(2018, 1, 1, 0, 5))])
+
+        rollup_service.update_spans = extend
+        try:
+            rollup_service.update_pending()
+        finally:
+            del rollup_service.update_spans
+
+        pending = RollupPending.query.get(self.tag_id)
+        self.assertEqual(pending.time_end, datetime(2018, 1, 1, 0, 5))
@@ -0,0 +1,143 @@
+"""
+tests.test_spool
+
+Tests of collector on-disk queue
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from wiim.collector.spool import Spool, SPARE
+
+
+def record(index):
+    return {'tag_id': 1, 'time_opc': '2018-01-01T00:00:00', 'value': index, 'quality': 'Good'}
+
+
+class SpoolTest(unittest.TestCase):
+    """ Records kept in order through segments, restarts and acks """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spools = []
+
+    def tearDown(self):
+        for spool in self.spools:
+            if not spool.closing.is_set():
+                spool.close()
+        shutil.rmtree(self.path)
+
+    def open(self, sync_interval=60):
+        spool = Spool(self.path, segment_size=1024, sync_interval=sync_interval)
+        self.spools.append(spool)
+        return spool
+
+    def values(self, spool, count=10000):
+        return [r['value'] for r in spool.read(count)[0]]
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def test_rollover(self):
+        spool = self.open()
+        for index in range(100):
+            spool.append(record(index))
+
+        self.assertGreater(len(self.segment_files()), 1)
+        self.assertEqual(spool.pending, 100)
+        self.assertEqual(self.values(spool), list(range(100)))
+
+    def test_spare_segment(self):
+        spool = self.open()
+        spool.append(record(0))
+        spool.sync()
+        self.assertTrue(os.path.exists(os.path.join(self.path, SPARE)))
+
+        files = self.segment_files()
+        for index in range(1, 100):
+            spool.append(record(index))
+
+        # spare numbered when used, next one created by sync
+        self.assertFalse(os.path.exists(os.path.join(self.path, SPARE)))
+        self.assertGreater(len(self.segment_files()), len(files))
+        self.assertEqual(self.values(spool), list(range(100)))
+
+        spool.close()
+        self.assertEqual(self.values(self.open()), list(range(100)))
+
+    def test_concurrent_sync(self):
+        spool = self.open(sync_interval=0.001)
+        errors = []
+
+        def append():
+            try:
+                for index in range(2000):
+                    spool.append(record(index))
+            except Exception as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=append)
+        thread.start()
+        thread.join()
+        spool.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.values(self.open()), list(range(2000)))
+
+    def test_reload_cursor(self):
+        spool = self.open()
+        for index in range(100):
+            spool.append(record(index))
+
+        records, positions = spool.read(30)
+        spool.ack(positions[-1], len(records))
+        spool.close()
+
+        spool = self.open()
+        self.assertEqual(spool.pending, 70)
+        self.assertEqual(self.values(spool), list(range(30, 100)))
+
+    def test_ack_removes_segments(self):
+        spool = self.open()
+        for index in range(100):
+            spool.append(record(index))
+        files = self.segment_files()
+
+        records, positions = spool.read(100)
+        spool.ack(positions[-1], len(records))
+
+        self.assertEqual(spool.pending, 0)
+        self.assertEqual(self.values(spool), [])
+        self.assertEqual(self.segment_files(), files[-1:])
+
+        # continues after acknowledged ones
+        spool.append(record(100))
+        self.assertEqual(self.values(spool), [100])
+
+    def test_torn_write(self):
+        spool = self.open()
+        for index in range(3):
+            spool.append(record(index))
+
+        # last entry partially written before a crash
+        segment = spool.segments[spool.last]
+        segment.map[segment.end - 2] ^= 0xff
+        spool.close()
+
+        spool = self.open()
+        self.assertEqual(self.values(spool), [0, 1])
+
+        # appends after the last valid entry
+        spool.append(record(3))
+        self.assertEqual(self.values(spool), [0, 1, 3])
+
+    def test_record_bigger_than_segment(self):
+        spool = self.open()
+
+        with self.assertRaises(ValueError):
+            spool.append(dict(record(0), value='x' * 2048))
@@ -22,6 +22,10 @@ def create_app(config_filename):
 
     # import modules
     from wiim import api
+    from wiim.encoder import JSONProvider
+
+    # set JSON encoder of responses
+    JSONProvider(app)
 
     # initialize modules and default routes
     with app.app_context():
@@ -7,26 +7,249 @@ Include routes management for API
 :license: AGPLv3/Commercial, see LICENSE file for more details
 """
 
-from flask import Blueprint, make_response, request, send_file, jsonify
-from flask_caching import Cache
+import math
+import time
+import random
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+from urllib.parse import urlencode
+from flask import Blueprint, Response, current_app, make_response, request, send_file,\
+    stream_with_context
 from werkzeug.exceptions import HTTPException
 # application imports
 from wiim import qrcode
+from wiim.encoder import jsonify
+from .database import read_primary, read_binds, PRIMARY_COOKIE, READ_METHODS
+from .feed import record_feed
 # from .services import Record, Tag, Server, Process, Zone, Site
 from .services import record_service, tag_service, server_service,\
-    process_service, zone_service, site_service, timeline_service
-
-# Cache requests
-cache = Cache()
+    process_service, zone_service, site_service, timeline_service, rollup_service,\
+    aggregate_service, db, cache, cache_versions, version_time, EXPORT_FORMATS
 
 # Define the blueprint: 'api', set its url prefix: app.url/api
 api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
 
 
+# ----> CACHE <-----
+
+def query_args():
+    """ Normalized query args of request
+
+    Equivalent queries give the same args, as count, since, order and tags
+    are reduced to values that change the result.
+
+    Returns:
+        A list of (name, value) tuples
+    """
+    args = []
+
+    # query limit, zero and over limit are the same as the limit
+    limit = current_app.config['WIIM_COUNT_LIMIT']
+    count = request.args.get('count', '0')
+    if count.isdigit():
+        count = int(count)
+        count = limit if not count or count > limit else count
+    args.append(('count', count))
+
+    # ignored when zero
+    since = request.args.get('since', '0')
+    if since.isdigit():
+        since = int(since)
+    if since:
+        args.append(('since', since))
+
+    # only known orders change the result
+    order = request.args.get('order', None)
+    if order in ('asc', 'desc'):
+        args.append(('order', order))
+
+    # tags list without order and duplicates
+    tags = request.args.getlist('tags')
+    if tags:
+        args.append(('tags', ','.join(sorted(set(tags), key=lambda t: (len(t), t)))))
+
+    return args
+
+
+def request_tags(id=None):
+    """ Tags ids of records views, from view arg or tags query arg
+
+    Args:
+        id (int, optional): tag id of view
+
+    Returns:
+        A list of tags ids or None for all tags
+    """
+    if id is not None:
+        return [id]
+
+    return request.args.getlist('tags', type=int) or None
+
+
+def cache_key(*tables):
+    """ Cache key maker from request path, normalized query args and tables versions
+
+    Unknown args are ignored, writes to any of the tables change its version
+    and so the key.
+
+    Args:
+        *tables (str): tables names that the view depends on
+
+    Returns:
+        A function to be used as cached key_prefix
+    """
+    def make_key():
+        args = query_args()
+
+        # current versions of the tables
+        if tables:
+            args.append(('v', ','.join(cache_versions(tables))))
+
+        return 'view/{}?{}'.format(request.path, urlencode(args))
+
+    return make_key
+
+
+def conditional(*tables, records=None):
+    """ Conditional GET with strong ETag and Last-Modified from tables versions
+
+    Validators are known before the view runs, so unchanged resources
+    are answered with 304 without query or serialization.
+
+    Args:
+        *tables (str): tables names that the view depends on
+
+    Kwargs:
+        records (function, optional): view also changes with new records, gets
+            tags ids of the view, or None for all, from view args and uses
+            their last records
+    """
+    def decorator(view):
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            # long-poll answers when data changes, validators of now would be stale,
+            # like validators of records for rollups, updated later than records
+            if request.args.get('wait') or (records and request.args.get('resolution')):
+                return view(*args, **kwargs)
+
+            versions = cache_versions(tables)
+            modified = [version_time(v) for v in versions]
+
+            # tables changed recently may not be in replicas yet
+            lag = timedelta(seconds=current_app.config['WIIM_REPLICA_LAG'])
+            if modified and max(modified) >= datetime.utcnow() - lag:
+                read_primary()
+
+            # all args, as records views use more than the normalized ones
+            params = query_args()
+            for name in sorted(request.args):
+                if name not in ('count', 'since', 'order', 'tags'):
+                    params.extend((name, v) for v in request.args.getlist(name))
+
+            key = [request.path, urlencode(params)] + versions
+
+            if records:
+                count, total, timestamp = record_service.latest(records(**kwargs))
+                key.append('{}:{}'.format(count, total))
+                if timestamp is not None:
+                    modified.append(datetime.utcfromtimestamp(float(timestamp)))
+
+            etag = hashlib.sha1('\n'.join(key).encode()).hexdigest()
+            last_modified = max(modified) if modified else None
+
+            # check validators of client before run the view
+            response = Response()
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.make_conditional(request)
+            if response.status_code == 304:
+                return response  # not modified
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                response.last_modified = last_modified
+
+            return response
+
+        return decorated
+
+    return decorator
+
+
+def cached(key_prefix, timeout=None):
+    """ Cache view responses, recomputed by a single worker at a time
+
+    On a miss only the worker that takes the lock runs the view, the others
+    wait for its response. Before expiration the response is refreshed early,
+    with probability growing as it gets closer and as the view is slower
+    (XFetch), so hot keys don't expire for all workers together.
+
+    Args:
+        key_prefix (function): cache key maker, from cache_key
+
+    Kwargs:
+        timeout (int, optional): seconds to keep, default is CACHE_DEFAULT_TIMEOUT
+    """
+    def decorator(view):
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            key = key_prefix()
+            lock_timeout = current_app.config['WIIM_CACHE_LOCK_TIMEOUT']
+
+            # cached as (body, status, headers, expires, compute seconds)
+            entry = cache.get(key)
+            if entry is not None:
+                expires, delta = entry[3:]
+                gap = delta * current_app.config['WIIM_CACHE_BETA'] * \
+                    -math.log(1 - random.random())
+
+                if time.time() + gap < expires:
+                    return current_app.response_class(*entry[:3])
+
+            if cache.add('lock/' + key, 1, timeout=lock_timeout):
+                try:
+                    start = time.time()
+                    response = make_response(view(*args, **kwargs))
+                    delta = time.time() - start
+
+                    if response.status_code == 200:
+                        ttl = timeout or cache.cache.default_timeout
+                        expires = time.time() + ttl if ttl else math.inf
+                        response.direct_passthrough = False
+                        cache.set(key, (response.get_data(), response.status_code,
+                                        response.headers.to_wsgi_list(), expires, delta),
+                                  timeout=ttl)
+                finally:
+                    cache.delete('lock/' + key)
+
+                return response
+
+            # other worker is refreshing it
+            if entry is not None:
+                return current_app.response_class(*entry[:3])
+
+            # wait other worker compute it
+            deadline = time.time() + lock_timeout
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry is not None:
+                    return current_app.response_class(*entry[:3])
+
+            return view(*args, **kwargs)  # too slow, do it anyway
+
+        return decorated
+
+    return decorator
+
+
 # ----> GET MULTIPLES <-----
 
 @api_bp.route('/sites', methods=['GET'])
-@cache.cached()
+@conditional('site')
+@cached(cache_key('site'))
 def get_sites():
     """ Get all Sites """
     # get params from que url query
@@ -39,7 +262,8 @@ def get_sites():
 
 @api_bp.route('/zones', methods=['GET'])
 @api_bp.route('/sites/<int:id>/zones', methods=['GET'])
-@cache.cached()
+@conditional('zone')
+@cached(cache_key('zone'))
 def get_zones(id=None):
     """ Get all Zones """
     # get params from que url query
@@ -61,7 +285,8 @@ def get_zones(id=None):
 
 @api_bp.route('/processes', methods=['GET'])
 @api_bp.route('/zones/<int:id>/processes', methods=['GET'])
-@cache.cached()
+@conditional('process')
+@cached(cache_key('process'))
 def get_processes(id=None):
     """ Get all Processes """
     # get params from que url query
@@ -82,7 +307,8 @@ def get_processes(id=None):
 
 
 @api_bp.route('/servers', methods=['GET'])
-@cache.cached()
+@conditional('server')
+@cached(cache_key('server'))
 def get_servers():
     """ Get all Servers """
     # get params from que url query
@@ -95,7 +321,8 @@ def get_servers():
 
 @api_bp.route('/tags', methods=['GET'])
 @api_bp.route('/servers/<int:id>/tags', methods=['GET'])
-@cache.cached()
+@conditional('tag')
+@cached(cache_key('tag'))
 def get_tags(id=None):
     """ Get all Tags """
     # get params from que url query
@@ -116,7 +343,8 @@ def get_tags(id=None):
 
 
 @api_bp.route('/processes/<int:id>/tags', methods=['GET'])
-@cache.cached()
+@conditional('tag')
+@cached(cache_key('tag'))
 def get_process_tags(id):
     """ Get all tags from process """
     # get params from que url query
@@ -130,50 +358,148 @@ def get_process_tags(id):
 
 @api_bp.route('/records', methods=['GET'])
 @api_bp.route('/tags/<int:id>/records', methods=['GET'])
+@conditional('record', records=request_tags)
 def get_records(id=None):
     """ Return all Records """
     # get params from que url query
     count = int(request.args.get('count', 0))
     since = int(request.args.get('since', 0))
     order = request.args.get('order', None)
+    export = request.args.get('format', None)
+    cursor = request.args.get('cursor', None)
+    resolution = request.args.get('resolution', None)
+    interpolate = request.args.get('interpolate', None)
+
+    if id is not None and interpolate is not None:
+        # get values at regular times from compressed history
+        return jsonify(record_service.interpolate(
+            id,
+            start=request.args.get('from', None),
+            end=request.args.get('to', None),
+            step=interpolate
+        ))
+
+    if id is not None and resolution is not None:
+        # get rollups of tag in time window
+        return jsonify(rollup_service.get_by_tag(
+            id,
+            start=request.args.get('from', None),
+            end=request.args.get('to', None),
+            resolution=resolution,
+            points=int(request.args.get('points', 0)),
+            count=count,
+            order_by=order
+        ))
 
     if id is None:
         tags = request.args.getlist('tags')
 
         if tags:
             # get tags with id in list
-            return jsonify(record_service.get_by_tags(
-                tags,
+            def query():
+                return record_service.get_by_tags(
+                    tags,
+                    count,
+                    since_id=since,
+                    order_by=order,
+                    export=export,
+                    cursor=cursor
+                )
+        else:
+            # get all tags
+            def query():
+                return record_service.get_all(
+                    count,
+                    since_id=since,
+                    order_by=order,
+                    export=export,
+                    cursor=cursor
+                )
+    else:
+        # get only records from specified tag
+        tags = [id]
+
+        def query():
+            return record_service.get_all(
                 count,
                 since_id=since,
-                order_by=order
-            ))
+                order_by=order,
+                filters={'tag_id': id},
+                export=export,
+                cursor=cursor
+            )
 
-        # get all tags
-        return jsonify(record_service.get_all(count, since_id=since, order_by=order))
+    if export is not None:
+        return export_response(query(), export)
 
-    # get only records from specified tag
-    return jsonify(record_service.get_all(
-        count,
-        since_id=since,
-        order_by=order,
-        filters={'tag_id': id}
-    ))
+    result = wait_records([int(tag) for tag in tags], since, query)
+
+    return paginate_response(result, order, cursor)
 
 
 @api_bp.route('/processes/<int:id>/records', methods=['GET'])
+@conditional('record', 'tag', records=lambda id: tag_service.ids_by_process(id))
 def get_process_records(id=None):
     """ Return all Records from Process """
     # get params from que url query
     count = int(request.args.get('count', 0))
     since = int(request.args.get('since', 0))
     order = request.args.get('order', None)
+    export = request.args.get('format', None)
+    cursor = request.args.get('cursor', None)
 
     # get only records from specified tag
-    return jsonify(record_service.get_by_process(id, count, since_id=since, order_by=order))
+    result = record_service.get_by_process(
+        id,
+        count,
+        since_id=since,
+        order_by=order,
+        export=export,
+        cursor=cursor
+    )
+
+    if export is not None:
+        return export_response(result, export)
+
+    return paginate_response(result, order, cursor)
+
+
+@api_bp.route('/aggregate', methods=['GET'])
+@api_bp.route('/tags/<int:id>/aggregate', methods=['GET'])
+@conditional('record', records=request_tags)
+def get_aggregate(id=None):
+    """ Return aggregates of Tags Records in time buckets """
+    # get params from que url query
+    tags = [id] if id is not None else request.args.getlist('tags')
+    fn = request.args.get('fn', None)
+
+    return jsonify(aggregate_service.get_by_tags(
+        tags,
+        start=request.args.get('from', None),
+        end=request.args.get('to', None),
+        functions=fn.split(',') if fn else None,
+        bucket=request.args.get('bucket', None)
+    ))
+
+
+@api_bp.route('/processes/<int:id>/aggregate', methods=['GET'])
+@conditional('record', 'tag', records=lambda id: tag_service.ids_by_process(id))
+def get_process_aggregate(id):
+    """ Return aggregates of Records from Process Tags in time buckets """
+    # get params from que url query
+    fn = request.args.get('fn', None)
+
+    return jsonify(aggregate_service.get_by_process(
+        id,
+        start=request.args.get('from', None),
+        end=request.args.get('to', None),
+        functions=fn.split(',') if fn else None,
+        bucket=request.args.get('bucket', None)
+    ))
 
 
 @api_bp.route('/processes/<int:id>/timeline', methods=['GET'])
+@conditional('record', 'tag', records=lambda id: tag_service.ids_by_process(id))
 def get_process_timeline(id=None):
     """ Return all Records from Process """
     # get params from que url query
@@ -181,52 +507,76 @@ def get_process_timeline(id=None):
     since = int(request.args.get('since', 0))
     order = request.args.get('order', None)
 
+    def query():
+        return timeline_service.timeline(id, count, since_id=since, order_by=order)
+
     # get only records from specified tag
-    return jsonify(timeline_service.timeline(id, count, since_id=since, order_by=order))
+    return jsonify(wait_records(tag_service.ids_by_process(id) or [0], since, query))
+
+
+@api_bp.route('/records/stream', methods=['GET'])
+@api_bp.route('/tags/<int:id>/stream', methods=['GET'])
+def stream_records(id=None):
+    """ Push new Records of Tags as server-sent events """
+    tags = [id] if id is not None else request.args.getlist('tags', type=int)
+
+    return stream_response(tags)
+
+
+@api_bp.route('/processes/<int:id>/stream', methods=['GET'])
+def stream_process_records(id):
+    """ Push new Records of Process Tags as server-sent events """
+    return stream_response(tag_service.ids_by_process(id) or [0])
 
 
 # ----> GET SINGLE <-----
 
 @api_bp.route('/sites/<int:id>', methods=['GET'])
-@cache.cached()
+@conditional('site')
+@cached(cache_key('site'))
 def get_site(id):
     """ Get Sites with specified id """
     return jsonify(site_service.get_by_id(id))
 
 
 @api_bp.route('/zones/<int:id>', methods=['GET'])
-@cache.cached()
+@conditional('zone')
+@cached(cache_key('zone'))
 def get_zone(id):
     """ Get Zones with specified id """
     return jsonify(zone_service.get_by_id(id))
 
 
 @api_bp.route('/processes/<int:id>', methods=['GET'])
-@cache.cached()
+@conditional('process')
+@cached(cache_key('process'))
 def get_process(id):
     """ Get process with specified id """
     return jsonify(process_service.get_by_id(id))
 
 
 @api_bp.route('/servers/<int:id>', methods=['GET'])
-@cache.cached()
+@conditional('server')
+@cached(cache_key('server'))
 def get_server(id):
     """ Get Servers with specified id """
     return jsonify(server_service.get_by_id(id))
 
 
 @api_bp.route('/tags/<int:id>', methods=['GET'])
-@cache.cached()
+@conditional('tag')
+@cached(cache_key('tag'))
 def get_tag(id):
     """ Get Tag with specified id """
     return jsonify(tag_service.get_by_id(id))
 
 
 @api_bp.route('/records/<int:id>', methods=['GET'])
-@cache.cached()
+# not cached, creates don't change versions and a missing record may be created any time
 def get_record(id):
     """ Return Record with specified id """
-    return jsonify(record_service.get_by_id(id))
+    # with its time, only the partition of the record is read
+    return jsonify(record_service.get_by_id(id, request.args.get('time_opc', None)))
 
 
 # ----> CREATE <-----
@@ -279,6 +629,21 @@ def create_record(id):
     return jsonify(record_service.create(**request.json)), 201  # created
 
 
+@api_bp.route('/records/batch', methods=['POST'])
+def create_records():
+    """ Create many Records from a list, each one with tag id """
+    # clients replaying buffered records skip the already stored ones
+    dedupe = request.args.get('dedupe', '0').lower() in ('1', 'true')
+
+    result = record_service.create_many(request.json, dedupe=dedupe)
+
+    if not result['errors']:
+        return jsonify(result), 201  # created
+
+    # none created is a bad request, some created is a partial success
+    return jsonify(result), 207 if result['created'] else 400
+
+
 # ----> DELETE <-----
 
 @api_bp.route('/sites/<int:id>', methods=['DELETE'])
@@ -314,13 +679,15 @@ def destroy_tag(id):
 @api_bp.route('/records/<int:id>', methods=['DELETE'])
 def destroy_record(id):
     """ Delete record with specified id """
-    return jsonify(record_service.destroy_by_id(id)), 204  # deleted
+    return jsonify(record_service.destroy_by_id(
+        id, request.args.get('time_opc', None))), 204  # deleted
 
 
 # ----> QRCODE <-----
 
 @api_bp.route('/processes/<int:id>/qrcode', methods=['GET'])
-@cache.cached(timeout=3600)  # cache for 1 hour
+@conditional()
+@cached(cache_key(), timeout=3600)  # cache for 1 hour
 def get_process_qrcode(id):
     """ Get QRCode image for Tag """
     img = qrcode.generate('process:' + str(id))
@@ -329,7 +696,8 @@ def get_process_qrcode(id):
 
 
 @api_bp.route('/tags/<int:id>/qrcode', methods=['GET'])
-@cache.cached(timeout=3600)  # cache for 1 hour
+@conditional()
+@cached(cache_key(), timeout=3600)  # cache for 1 hour
 def get_tag_qrcode(id):
     """ Get QRCode image for Tag """
     img = qrcode.generate('tag:' + str(id))
@@ -345,6 +713,149 @@ def since_tag():
     return jsonify(tag_service.since())
 
 
+# ----> METRICS <-----
+
+@api_bp.route('/metrics/pool', methods=['GET'])
+def get_pool_metrics():
+    """ Get database connections pools metrics of this worker """
+    return jsonify(db.pool_metrics())
+
+
+# ----> HELPERS <-----
+
+def export_response(lines, export):
+    """ Stream generated lines as response in export format """
+    return Response(stream_with_context(lines), mimetype=EXPORT_FORMATS[export])
+
+
+def stream_response(tags):
+    """ Stream records of tags as server-sent events, all tags if empty
+
+    Clients resuming with Last-Event-ID header, or since arg, first get the
+    records they missed. When they are more than WIIM_FEED_BUFFER, or the
+    client is too slow to keep up, the stream ends after the last sent and
+    clients reconnect from it. Event ids are resume ids of the feed, so
+    records committed late are not lost, but may be sent again on resume.
+    """
+    since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    keepalive = current_app.config['WIIM_FEED_KEEPALIVE']
+    limit = current_app.config['WIIM_FEED_BUFFER']
+    dumps = current_app.extensions['json_provider'].dumps
+
+    # replicas may not have records already delivered by the feed
+    read_primary()
+
+    # subscribe before read missed records, so none is lost between them
+    subscriber = record_feed.subscribe(tags)
+    settled = record_feed.settled()
+    missed = record_feed.read(since, tags, limit) if since else []
+    if len(missed) == limit:
+        record_feed.unsubscribe(subscriber)
+        subscriber = None
+
+    def events():
+        # missed records may be delivered again by the feed
+        sent = {record['id'] for record in missed}
+        records = [(min(record['id'], settled), record) for record in missed]
+        resume_id = since
+
+        try:
+            while True:
+                for event_id, record in records:
+                    resume_id = max(resume_id, event_id)
+                    yield 'id: {}\ndata: {}\n\n'.format(resume_id, dumps(record))
+
+                if subscriber is None or subscriber.overflow:
+                    return
+
+                records = [(event_id, record) for event_id, record in
+                           subscriber.get(keepalive) if record['id'] not in sent]
+                if not records:
+                    yield ': keepalive\n\n'
+        finally:
+            if subscriber is not None:
+                record_feed.unsubscribe(subscriber)
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # no proxy buffering
+    })
+
+
+def wait_records(tags, since, query):
+    """ Long-poll, run query again when records newer than since arrive
+
+    With wait arg, clients get an empty result only after waiting that many
+    seconds, limited to WIIM_WAIT_LIMIT. Waiters are waked by the records
+    feed, without querying until there is something new.
+
+    Args:
+        tags (list of int): tags of records in query, all tags if empty
+        since (int): id of the last record the client has
+        query (function): return the result
+
+    Returns:
+        The result of query
+    """
+    wait = min(float(request.args.get('wait', 0)), current_app.config['WIIM_WAIT_LIMIT'])
+    if wait <= 0:
+        return query()
+
+    # subscribe before query, so none is lost between them
+    subscriber = record_feed.subscribe(tags)
+    deadline = time.time() + wait
+
+    try:
+        result = query()
+
+        while not result:
+            # release connection while waiting, next query sees new snapshot
+            db.session.close()
+
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+
+            # late commits may have ids lower than since
+            if subscriber.get(timeout) or subscriber.overflow:
+                # replicas may not have the new records yet
+                read_primary()
+                result = query()
+
+                if subscriber.overflow:
+                    break
+    finally:
+        record_feed.unsubscribe(subscriber)
+
+    return result
+
+
+def paginate_response(result, order, cursor=None):
+    """ Records response with continuation token for next page in header """
+    response = jsonify(result)
+
+    # continue with the order of the first page
+    if cursor is not None:
+        order = record_service.decode_cursor(cursor)[2]
+
+    next_cursor = record_service.next_cursor(result, order)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+
+    return response
+
+
+@api_bp.after_request
+def read_your_writes(response):
+    """ Client reads from primary for a while after its writes, if there are replicas """
+    if request.method not in READ_METHODS and response.status_code < 400 and \
+            read_binds(current_app):
+        response.set_cookie(PRIMARY_COOKIE, '1',
+                            max_age=current_app.config['WIIM_REPLICA_LAG'])
+
+    return response
+
+
 # ----> ERRORS <-----
 
 @api_bp.errorhandler(Exception)
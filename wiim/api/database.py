@@ -0,0 +1,172 @@
+"""
+wiim.api.database
+
+Database extension with tuned pool, pool metrics and read replicas routing
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import time
+import random
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import QueuePool
+
+# requests methods that only read from database
+READ_METHODS = ('GET', 'HEAD')
+# cookie of clients that wrote recently, read from primary to see their writes
+PRIMARY_COOKIE = 'wiim_primary'
+
+
+class MeteredQueuePool(QueuePool):
+    """ Queue pool that counts checkouts and time waiting for connections
+
+    Attributes:
+        checkouts (int): connections taken from pool
+        timeouts (int): checkouts that waited more than pool timeout
+        wait (float): total seconds waiting for connections
+        max_wait (float): longest wait in seconds
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+
+    def recreate(self):
+        # keep metrics when pool is recreated after disconnections
+        pool = super(MeteredQueuePool, self).recreate()
+        pool.checkouts, pool.timeouts = self.checkouts, self.timeouts
+        pool.wait, pool.max_wait = self.wait, self.max_wait
+
+        return pool
+
+    def _do_get(self):
+        start = time.time()
+
+        try:
+            return super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            wait = time.time() - start
+            self.checkouts += 1
+            self.wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def metrics(self):
+        """ Get pool usage and checkout metrics
+
+        Returns:
+            A dict with pool size, connections in use and waits
+        """
+        return {
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_avg': self.wait / self.checkouts if self.checkouts else 0.0,
+            'wait_max': self.max_wait,
+        }
+
+
+def read_primary():
+    """ Read from primary in current request, as replicas may not have recent writes """
+    g.read_primary = True
+
+
+class RoutingSession(SignallingSession):
+    """ Session that reads from a replica bind in GET requests
+
+    A replica is chosen once per request, so all its queries see the same data.
+    Requests after a write of the same client, by PRIMARY_COOKIE, or marked with
+    read_primary read from primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = self.read_bind()
+        if bind is not None:
+            return bind
+
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def read_bind(self):
+        """ Get engine of replica bind, when request only reads and replicas are set """
+        if not has_request_context() or request.method not in READ_METHODS:
+            return None
+
+        if g.get('read_primary') or request.cookies.get(PRIMARY_COOKIE):
+            return None
+
+        if 'read_bind' not in g:
+            binds = read_binds(self.app)
+            g.read_bind = random.choice(binds) if binds else None
+
+        if g.read_bind is None:
+            return None
+
+        return get_state(self.app).db.get_engine(self.app, bind=g.read_bind)
+
+
+class Database(SQLAlchemy):
+    """ SQLAlchemy extension with MySQL pool settings and routing session """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(Database, self).apply_driver_hacks(app, info, options)
+
+        if info.drivername.startswith('mysql'):
+            options['poolclass'] = MeteredQueuePool
+            options['pool_pre_ping'] = app.config['SQLALCHEMY_POOL_PRE_PING']
+
+    def get_engine(self, app=None, bind=None):
+        engine = super(Database, self).get_engine(app, bind)
+
+        # read-only transactions, safer and lighter for InnoDB
+        if bind is not None and bind in read_binds(self.get_app(app)) and \
+                engine.dialect.name == 'mysql' and \
+                not event.contains(engine, 'connect', set_read_only):
+            event.listen(engine, 'connect', set_read_only)
+
+        return engine
+
+    def pool_metrics(self, app=None):
+        """ Get metrics of the pools of primary and binds engines
+
+        Returns:
+            A dict with bind name, primary is 'default', and its pool metrics
+        """
+        app = self.get_app(app)
+        binds = [None] + list(app.config['SQLALCHEMY_BINDS'] or ())
+        result = {}
+
+        for bind in binds:
+            pool = self.get_engine(app, bind).pool
+            if isinstance(pool, MeteredQueuePool):
+                result[bind or 'default'] = pool.metrics()
+
+        return result
+
+
+def read_binds(app):
+    """ Get replicas binds of WIIM_READ_BINDS that are in SQLALCHEMY_BINDS """
+    binds = app.config['SQLALCHEMY_BINDS'] or ()
+
+    return [bind for bind in app.config['WIIM_READ_BINDS'] if bind in binds]
+
+
+def set_read_only(dbapi_connection, connection_record):
+    """ Set new connection session transactions as read only """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('SET SESSION TRANSACTION READ ONLY')
+    cursor.close()
@@ -0,0 +1,249 @@
+"""
+wiim.api.feed
+
+Feed of new records pushed to subscribers
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import time
+import threading
+from collections import deque
+from flask import current_app
+from .models import db, Record, RecordSchema
+from .serializers import RowSerializer
+
+
+class Subscriber():
+    """ Client of feed with its own bounded queue of records
+
+    Args:
+        tags (set of int, optional): only records of these tags, None for all
+        size (int): maximum records queued before overflow
+
+    Attributes:
+        overflow (bool): client is too slow and missed records
+    """
+
+    def __init__(self, tags, size):
+        self.tags = tags
+        self.size = size
+        self.queue = deque()
+        self.overflow = False
+        self.event = threading.Event()
+
+    def put(self, records):
+        """ Queue records of subscribed tags and wake client
+
+        Args:
+            records (list): tuples of resume id and record dict
+        """
+        for resume_id, record in records:
+            if self.tags is not None and record['tag'] not in self.tags:
+                continue
+
+            if len(self.queue) >= self.size:
+                self.overflow = True
+                break
+
+            self.queue.append((resume_id, record))
+
+        self.event.set()
+
+    def get(self, timeout):
+        """ Wait for records
+
+        Args:
+            timeout (float): seconds to wait
+
+        Returns:
+            A list of tuples of resume id and record dict, empty if none arrived in time
+        """
+        self.event.wait(timeout)
+        self.event.clear()
+
+        records = []
+        while self.queue:
+            records.append(self.queue.popleft())
+
+        return records
+
+
+class RecordFeed():
+    """ Single reader of new records shared by all subscribers of the worker
+
+    A thread reads records newer than the last one delivered, waked by inserts
+    of this worker or every WIIM_FEED_INTERVAL seconds for inserts of others
+    workers and collectors, and fans them out to subscribers. It only queries
+    while there are subscribers.
+
+    Ids are taken on insert but seen on commit, so a transaction may commit
+    a record with a lower id than ones already delivered. Ids missing below
+    the last delivered are kept as gaps and read again for WIIM_FEED_LAG
+    seconds, after that they are taken as rolled back. Records are delivered
+    with a resume id, below which all records were delivered, for clients
+    to continue from without losing the late ones.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.last_id = None
+        # missing ids below last id and their expiration time
+        self.gaps = {}
+        self.serializer = RowSerializer(Record, RecordSchema)
+
+    def subscribe(self, tags=None):
+        """ Add subscriber, starting the feed thread if not running
+
+        Kwargs:
+            tags (list of int, optional): only records of these tags
+
+        Returns:
+            The Subscriber
+        """
+        app = current_app._get_current_object()
+        subscriber = Subscriber(set(tags) if tags else None, app.config['WIIM_FEED_BUFFER'])
+
+        with self.lock:
+            # deliver records newer than the ones existing now
+            if self.last_id is None:
+                self.start(app)
+
+            self.subscribers.add(subscriber)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, args=(app,), daemon=True)
+                self.thread.start()
+
+        self.wake.set()
+
+        return subscriber
+
+    def start(self, app):
+        """ Start from last record of primary, with missing ids before it as gaps """
+        size = app.config['WIIM_FEED_BUFFER']
+
+        # replicas may not have the last records yet
+        with db.engine.connect() as connection:
+            last_id = connection.execute(db.select([db.func.max(Record.id)])).scalar() or 0
+            ids = {id for id, in connection.execute(
+                db.select([Record.id]).where(Record.id > last_id - size))}
+
+        self.last_id = last_id
+        self.gaps = {}
+        self.add_gaps(app, set(range(max(last_id - size, 0) + 1, last_id + 1)) - ids)
+
+    def add_gaps(self, app, ids):
+        """ Read ids again until WIIM_FEED_LAG, keeping the WIIM_FEED_BUFFER newest ones """
+        expires = time.monotonic() + app.config['WIIM_FEED_LAG']
+        self.gaps.update((id, expires) for id in ids)
+
+        size = app.config['WIIM_FEED_BUFFER']
+        if len(self.gaps) > size:
+            for id in sorted(self.gaps)[:len(self.gaps) - size]:
+                del self.gaps[id]
+
+    def settled(self):
+        """ Id of record below which all records were delivered or rolled back """
+        with self.lock:
+            return min(self.gaps) - 1 if self.gaps else self.last_id
+
+    def unsubscribe(self, subscriber):
+        """ Remove subscriber """
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def notify(self):
+        """ Wake feed thread, records were inserted """
+        self.wake.set()
+
+    def read(self, since, tags=None, limit=0, gaps=None):
+        """ Get records newer than since
+
+        Args:
+            since (int): only records with id greater than
+
+        Kwargs:
+            tags (list of int, optional): only records of these tags
+            limit (int, optional): maximum records, zero for no limit
+            gaps (iterable of int, optional): also records with these ids
+
+        Returns:
+            A list of records dicts ordered by id
+        """
+        condition = Record.id > since
+        if gaps:
+            condition = db.or_(condition, Record.id.in_(gaps))
+
+        query = db.session.query(*self.serializer.columns).filter(condition)
+
+        if tags:
+            query = query.filter(Record.tag_id.in_(tags))
+
+        query = query.order_by(Record.id)
+        if limit:
+            query = query.limit(limit)
+
+        return self.serializer.dump(query)
+
+    def run(self, app):
+        """ Feed thread loop """
+        while True:
+            self.wake.wait(app.config['WIIM_FEED_INTERVAL'])
+            self.wake.clear()
+
+            with self.lock:
+                subscribers = list(self.subscribers)
+
+                # next first subscriber starts from newest record
+                if not subscribers:
+                    self.last_id = None
+                    self.gaps = {}
+                    continue
+
+                # rolled back, or committed too late
+                now = time.monotonic()
+                for id in [id for id, expires in self.gaps.items() if expires < now]:
+                    del self.gaps[id]
+
+                last_id, gaps = self.last_id, list(self.gaps)
+
+            with app.app_context():
+                try:
+                    records = self.read(last_id, limit=app.config['WIIM_FEED_BUFFER'],
+                                        gaps=gaps)
+                except Exception:
+                    app.logger.exception('Record feed read failed')
+                    records = []
+                finally:
+                    db.session.remove()
+
+            if not records:
+                continue
+
+            with self.lock:
+                # ids skipped by the new records are not committed yet
+                ids = {record['id'] for record in records}
+                top = records[-1]['id']
+                start = max(last_id, top - app.config['WIIM_FEED_BUFFER'])
+                for id in ids:
+                    self.gaps.pop(id, None)
+                self.add_gaps(app, set(range(start + 1, top)) - ids)
+                self.last_id = max(last_id, top)
+
+            settled = self.settled()
+            records = [(min(record['id'], settled), record) for record in records]
+            for subscriber in subscribers:
+                subscriber.put(records)
+
+            # there may be more
+            if len(records) == app.config['WIIM_FEED_BUFFER']:
+                self.wake.set()
+
+
+# Initialize feed
+record_feed = RecordFeed()
@@ -9,13 +9,57 @@ using collation utf8mb4_unicode_ci
 """
 
 from flask import request
-from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.dialects import mysql
-from marshmallow import fields
+from marshmallow import fields, validate, ValidationError
 from flask_marshmallow import Marshmallow
+from flask_caching import Cache
+from .database import Database
 
-db = SQLAlchemy()
+db = Database()
 ma = Marshmallow()
+cache = Cache()
+
+# Tag data types and record column where its values are stored
+DATA_TYPES = {
+    'double': 'value_double',
+    'int': 'value_int',
+    'bool': 'value_bool',
+    'string': 'value_text',
+}
+
+# Tag deadband types and OPC-UA DeadbandType of data change filter
+DEADBAND_TYPES = {
+    'absolute': 1,
+    'percent': 2,
+}
+
+# Record quality names and stored status codes, from OPC-UA severity
+QUALITY_CODES = {
+    'Good': 0,
+    'Uncertain': 1,
+    'Bad': 2,
+}
+QUALITY_NAMES = {v: k for k, v in QUALITY_CODES.items()}
+
+
+def quality_code(value):
+    """ Get stored status code of a quality
+
+    Args:
+        value (str or int): quality name, any OPC-UA status name like
+            GoodClamped or BadCommunicationError, or numeric OPC-UA status code
+
+    Returns:
+        One of QUALITY_CODES values or None if it's not a quality
+    """
+    if isinstance(value, str):
+        # by severity in name, as the migration of stored names
+        for name in ('Good', 'Uncertain', 'Bad'):
+            if name in value:
+                return QUALITY_CODES[name]
+    elif isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= 0xFFFFFFFF:
+        # severity is in two highest bits, reserved 11 is also bad
+        return min(value >> 30, QUALITY_CODES['Bad'])
 
 
 # ----> MODELS <-----
@@ -52,7 +96,9 @@ process_tags = db.Table(
     # many to many table
     'process_tags',
     db.Column('process_id', db.Integer, db.ForeignKey('process.id')),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'))
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
+    # reverse index: processes of a tag
+    db.Index('idx_process_tags__tag', 'tag_id', 'process_id')
 )
 
 
@@ -77,6 +123,10 @@ class Server(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     uid = db.Column(db.String(64), nullable=False)
+    # OPC-UA endpoint url read by collector, empty to not collect
+    endpoint = db.Column(db.String(255))
+    # days to keep records of tags, empty to use WIIM_RETENTION_DAYS
+    retention = db.Column(db.Integer)
     # foreign key: one server have many tags
     tags = db.relationship('Tag', backref='server')
 
@@ -93,6 +143,22 @@ class Tag(db.Model):
     comment = db.Column(db.String(120))
     unit = db.Column(db.String(64))
     icon = db.Column(db.String(255))
+    # OPC-UA node id of variable subscribed by collector, empty to not collect
+    node_id = db.Column(db.String(255))
+    # days to keep records, empty to use server retention
+    retention = db.Column(db.Integer)
+    # type of values, one of DATA_TYPES
+    data_type = db.Column(db.String(8), nullable=False, default='double',
+                          server_default='double')
+    # minimum change of value to store a record, empty to store all changes
+    deadband = db.Column(mysql.DOUBLE(asdecimal=False))
+    # deadband in value units or percent of range, one of DEADBAND_TYPES
+    deadband_type = db.Column(db.String(8), nullable=False, default='absolute',
+                              server_default='absolute')
+    # maximum seconds without records, repeating last value, empty for no limit
+    heartbeat = db.Column(db.Integer)
+    # swinging door compression deviation, empty to store all values
+    compression = db.Column(mysql.DOUBLE(asdecimal=False))
     # foreign key: one tag have one server
     server_id = db.Column(db.Integer, db.ForeignKey('server.id'), nullable=False)
     # server = db.relationship('Server')
@@ -105,21 +171,94 @@ class Tag(db.Model):
 
 class Record(db.Model):
     """ Record model """
-    __table_args__ = {'mysql_engine': 'MyISAM'}  # table engine
+    __table_args__ = (
+        # records of tags ordered by time, id as tiebreaker
+        db.Index('idx_record__tag_time', 'tag_id', 'time_opc', 'id'),
+        # records of many tags ordered by time
+        db.Index('idx_record__time', 'time_opc'),
+        # partitioned by time_opc range, see RetentionService
+        {'mysql_engine': 'InnoDB'}  # table engine
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     time_opc = db.Column(mysql.DATETIME(fsp=3), nullable=False)
     time_db = db.Column(mysql.TIMESTAMP(fsp=3), nullable=False)
-    value = db.Column(db.String(120), nullable=False)
-    quality = db.Column(db.String(64), nullable=False)
-    # foreign key: one record have one tag
+    # only the column of tag data type is filled
+    value_double = db.Column(mysql.DOUBLE(asdecimal=False))
+    value_int = db.Column(db.BigInteger)
+    value_bool = db.Column(db.Boolean)
+    value_text = db.Column(db.String(120))
+    # status code, one of QUALITY_CODES
+    quality = db.Column(db.SmallInteger, nullable=False)
+    # foreign key: one record have one tag, not enforced by partitioned table
     tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), nullable=False)
     # tag = db.relationship('Tag')
 
+    @property
+    def value(self):
+        """ Value from the column of tag data type """
+        for value in (self.value_double, self.value_int, self.value_bool, self.value_text):
+            if value is not None:
+                return value
+
     def __repr__(self):
         return '<Record {}>'.format(self.id)
 
 
+class TagLatest(db.Model):
+    """ Last record of each tag, maintained on record inserts """
+
+    # foreign key: one tag have one last record
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'),
+                       primary_key=True)
+    # no foreign key constraint because record table is partitioned
+    record_id = db.Column(db.Integer, nullable=False)
+    # time of last record, so it's read only from its partition
+    time_opc = db.Column(mysql.DATETIME(fsp=3), nullable=False)
+
+    def __repr__(self):
+        return '<TagLatest {}>'.format(self.tag_id)
+
+
+class Rollup(db.Model):
+    """ Aggregates of numeric tag records by time bucket """
+    __tablename__ = 'record_rollup'
+
+    # foreign key: one tag have many rollups
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'),
+                       primary_key=True)
+    # bucket size in seconds and bucket start time
+    resolution = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bucket = db.Column(mysql.DATETIME(), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    sum = db.Column(mysql.DOUBLE(asdecimal=False), nullable=False)
+    min = db.Column(mysql.DOUBLE(asdecimal=False), nullable=False)
+    max = db.Column(mysql.DOUBLE(asdecimal=False), nullable=False)
+    # values of first and last records in bucket
+    first = db.Column(mysql.DOUBLE(asdecimal=False), nullable=False)
+    last = db.Column(mysql.DOUBLE(asdecimal=False), nullable=False)
+
+    def __repr__(self):
+        return '<Rollup {} {} {}>'.format(self.tag_id, self.resolution, self.bucket)
+
+
+class RollupPending(db.Model):
+    """ Time span of tag records waiting for deferred rollup update """
+    __tablename__ = 'rollup_pending'
+
+    # foreign key: one tag have one pending span
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'),
+                       primary_key=True)
+    # first and last time_opc of records inserted since last update
+    time_start = db.Column(mysql.DATETIME(fsp=3), nullable=False)
+    time_end = db.Column(mysql.DATETIME(fsp=3), nullable=False)
+    # incremented when span is extended, so it's removed only if not changed
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    def __repr__(self):
+        return '<RollupPending {}>'.format(self.tag_id)
+
+
 # ----> SCHEMAS <-----
 
 class SiteSchema(ma.ModelSchema):
@@ -175,11 +314,20 @@ class TagSchema(ma.ModelSchema):
 
     class Meta:
         # Fields to expose
-        fields = ('id', 'name', 'alias', 'comment', 'unit', 'icon', 'icon_url', 'server')
+        fields = ('id', 'name', 'alias', 'comment', 'unit', 'icon', 'icon_url', 'server',
+                  'node_id', 'retention', 'data_type', 'deadband', 'deadband_type',
+                  'heartbeat', 'compression')
         model = Tag
+        # columns read by methods in row serializer
+        row_columns = ('icon',)
 
     # server = fields.Nested(ServerSchema)
     icon_url = fields.Method('get_icon_url')
+    data_type = fields.String(validate=validate.OneOf(DATA_TYPES))
+    deadband = fields.Float(allow_none=True, validate=validate.Range(min=0))
+    deadband_type = fields.String(validate=validate.OneOf(DEADBAND_TYPES))
+    heartbeat = fields.Integer(allow_none=True, validate=validate.Range(min=1))
+    compression = fields.Float(allow_none=True, validate=validate.Range(min=0))
 
     def get_icon_url(self, tag):
         if tag.icon:
@@ -193,8 +341,25 @@ class RecordSchema(ma.ModelSchema):
 
     class Meta:
         # Fields to expose
-        # fields = ('id', 'time_opc', 'time_db', 'value', 'quality')
+        fields = ('id', 'time_opc', 'time_db', 'value', 'quality', 'tag')
         model = Record
+        # columns read by methods and properties in row serializer
+        row_columns = ('quality', 'value_double', 'value_int', 'value_bool', 'value_text')
+
+    # typed value and quality name, converted by RecordService
+    value = fields.Raw(required=True, allow_none=False)
+    quality = fields.Method('get_quality', deserialize='load_quality', required=True)
+
+    def get_quality(self, record):
+        return QUALITY_NAMES.get(record.quality)
+
+    def load_quality(self, value):
+        code = quality_code(value)
+        if code is None:
+            raise ValidationError('Not a valid quality, use one of: {} or a status code.'.format(
+                ', '.join(QUALITY_CODES)))
+
+        return code
 
     # tag = fields.Nested(TagSchema)
 
@@ -204,6 +369,21 @@ class RecordSchema(ma.ModelSchema):
     # })
 
 
+class RollupSchema(ma.ModelSchema):
+    """ Serializing Schema for Rollup """
+
+    class Meta:
+        # Fields to expose
+        fields = ('tag', 'resolution', 'bucket', 'count', 'min', 'max', 'avg', 'first', 'last')
+        model = Rollup
+
+    tag = fields.Integer(attribute='tag_id')
+    avg = fields.Method('get_avg')
+
+    def get_avg(self, rollup):
+        return rollup.sum / rollup.count
+
+
 class TimelineSchema(ma.ModelSchema):
     """ Deserializing Schema for Timeline (Tag, Record) """
 
@@ -0,0 +1,117 @@
+"""
+wiim.api.serializers
+
+Fast serializers of query rows compiled from schemas fields
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+from marshmallow import fields
+from marshmallow.utils import isoformat
+from sqlalchemy import inspect
+from sqlalchemy.orm import ColumnProperty, RelationshipProperty
+
+
+class Prefixed():
+    """ Row attributes without labels prefix, for schema methods and model properties
+
+    Args:
+        row (tuple): query result row
+        prefix (str): prefix of row labels
+    """
+    __slots__ = ('row', 'prefix')
+
+    def __init__(self, row, prefix):
+        self.row = row
+        self.prefix = prefix
+
+    def __getattr__(self, name):
+        return getattr(self.row, self.prefix + name)
+
+
+class RowSerializer():
+    """ Serializer of rows with only the columns of schema fields
+
+    The dict of each row is built by a function generated once from
+    Meta.fields of schema, with the same output of schema dump.
+    Fields of schema methods or model properties read the columns
+    listed in Meta.row_columns.
+
+    Args:
+        model (class): model class
+        schema (class): marshmallow schema class with Meta.fields
+
+    Kwargs:
+        prefix (str, optional): prefix of columns labels, to select rows
+            of many models together
+
+    Attributes:
+        columns (list): columns to select in query
+        serialize (function): convert a row to dict
+
+    Raises:
+        Exception: If some field can not be read from columns
+    """
+
+    def __init__(self, model, schema, prefix=''):
+        schema = schema()
+        mapper = inspect(model)
+        keys = []  # columns keys to select
+        namespace = {'isoformat': isoformat, 'Prefixed': Prefixed}
+        items = []
+
+        def column(key):
+            if key not in keys:
+                keys.append(key)
+
+            return 'row.' + prefix + key
+
+        for key in getattr(schema.Meta, 'row_columns', ()):
+            column(key)
+
+        for name, field in schema.fields.items():
+            attr = field.attribute or name
+            prop = mapper.attrs[attr] if attr in mapper.attrs else None
+
+            if isinstance(field, fields.Method):
+                # schema method called with row as object
+                namespace['m_' + name] = getattr(schema, field.method_name)
+                value = 'm_{}(obj)'.format(name)
+            elif isinstance(prop, ColumnProperty):
+                value = column(prop.key)
+                if isinstance(field, fields.DateTime):
+                    value = '(isoformat({0}) if {0} is not None else None)'.format(value)
+            elif isinstance(prop, RelationshipProperty) and not prop.uselist:
+                # related id is the foreign key column
+                value = column(list(prop.local_columns)[0].key)
+            elif isinstance(getattr(model, attr, None), property):
+                namespace['p_' + name] = getattr(model, attr).fget
+                value = 'p_{}(obj)'.format(name)
+            else:
+                raise Exception('Field {} of {} has no column'.format(name, schema))
+
+            items.append('{!r}: {}'.format(name, value))
+
+        source = 'def serialize(row):\n    obj = {}\n    return {{{}}}\n'.format(
+            'Prefixed(row, {!r})'.format(prefix) if prefix else 'row',
+            ', '.join(items)
+        )
+        exec(compile(source, '<{} serializer>'.format(model.__name__), 'exec'), namespace)
+
+        self.serialize = namespace['serialize']
+        self.columns = [getattr(model, key).label(prefix + key) if prefix
+                        else getattr(model, key) for key in keys]
+
+    def dump(self, rows):
+        """ Convert rows to list of dicts
+
+        Args:
+            rows (iterable): query result rows with the columns
+
+        Returns:
+            A list with rows data mapped, every row is a dict
+        """
+        serialize = self.serialize
+
+        return [serialize(row) for row in rows]
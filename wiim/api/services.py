@@ -7,11 +7,92 @@ Include Models management for API
 :license: AGPLv3/Commercial, see LICENSE file for more details
 """
 
+import io
+import csv
+import json
+import math
+import time
+import base64
+import threading
+from uuid import uuid4
+from datetime import datetime, timedelta
 from flask import current_app as app
 from flask_sqlalchemy import get_debug_queries
-from sqlalchemy import func, and_
+from marshmallow.utils import isoformat, from_iso
+from sqlalchemy import func, and_, or_, literal_column, text, inspect, select, union_all
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import joinedload, selectinload
 # application imports
 from .models import *
+from .serializers import RowSerializer
+from .feed import record_feed
+
+# Available formats to stream records and its mimetypes
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# Rollup resolutions names and bucket sizes in seconds, finest first
+ROLLUP_RESOLUTIONS = (('1m', 60), ('1h', 3600), ('1d', 86400))
+# Reference time where rollup buckets start
+ROLLUP_EPOCH = datetime(2000, 1, 1)
+# Interpolation times with records looked up per query
+INTERPOLATE_CHUNK = 100
+# Range of int values, stored as BIGINT
+BIGINT_MIN, BIGINT_MAX = -2 ** 63, 2 ** 63 - 1
+# Seconds to keep cache versions, redis deletes keys added without expiration
+VERSION_TIMEOUT = 30 * 86400
+
+
+def parse_time(value):
+    """ Get naive datetime, as stored by database, from datetime or ISO string """
+    if isinstance(value, str):
+        value = from_iso(value)
+
+    return value.replace(tzinfo=None)
+
+
+def new_version():
+    """ Get a new and unique cache version, starting with its creation time """
+    return '{:x}.{}'.format(int(time.time()), uuid4().hex[:12])
+
+
+def version_time(version):
+    """ Get creation time of cache version as naive UTC datetime """
+    return datetime.utcfromtimestamp(int(version.split('.')[0], 16))
+
+
+def cache_versions(tables):
+    """ Get current cache versions of tables, starting the missing ones
+
+    Args:
+        tables (list of str): tables names
+
+    Returns:
+        A list with version of each table
+    """
+    keys = ['version/' + table for table in tables]
+    versions = cache.get_many(*keys)
+
+    for i, key in enumerate(keys):
+        if versions[i] is None:
+            # never restart from a value that may have been used before
+            version = new_version()
+            cache.add(key, version, timeout=VERSION_TIMEOUT)
+            # the one added first, by this or another worker
+            versions[i] = cache.get(key) or version
+
+    return versions
+
+
+def invalidate(tables):
+    """ Change cache versions of tables, so cached views of them are not used again
+
+    Args:
+        tables (list of str): tables names
+    """
+    cache.set_many({'version/' + table: new_version() for table in tables}, timeout=0)
 
 
 class BaseService():
@@ -20,17 +101,27 @@ class BaseService():
     Args:
         model (class): model class
         schema (class): marshmallow schema class
+        load (list, optional): loader options of relationships dumped by schema
 
     Attributes:
         model (class): model class
         schema (class): marshmallow schema class
         order_by (str): model column to order
+        load_options (list): loader options applied to every query
+        serializer (RowSerializer): fast serializer, only for schemas with Meta.fields
+        cache_tables (list of str): tables with cached views changed by writes,
+            the model and its related parents and children
     """
 
-    def __init__(self, model, schema):
+    def __init__(self, model, schema, load=None):
         self.Model = model
         self.Schema = schema
         self.order_by = model.id
+        self.load_options = load or []
+        self.serializer = RowSerializer(model, schema) \
+            if getattr(schema.Meta, 'fields', None) else None
+        self.cache_tables = [model.__tablename__] + \
+            [r.mapper.local_table.name for r in inspect(model).relationships]
 
     def create(self, **kwargs):
         """ Create a new entry
@@ -54,6 +145,7 @@ class BaseService():
         # commit to database
         db.session.add(item)
         db.session.commit()
+        invalidate(self.cache_tables)
 
         # get schema to return
         result = item_schema.dump(item).data
@@ -81,27 +173,59 @@ class BaseService():
         if not count or count > app.config['WIIM_COUNT_LIMIT']:
             count = app.config['WIIM_COUNT_LIMIT']
 
+        # only exposed columns without models, when enabled
+        if self.serializer is not None and app.config['WIIM_FAST_SERIALIZE']:
+            query = query.with_entities(*self.serializer.columns)
+            rows = self.filter_query(query, count, since_id, order_by, filters).all()
+
+            return self.serializer.dump(rows)
+
+        # do query, with related rows loaded together instead of one by row
+        query = query.options(*self.load_options)
+        items = self.filter_query(query, count, since_id, order_by, filters).all()
+        result = items_schema.dump(items).data
+
+        return result
+
+    def filter_query(self, query, count=0, since_id=0, order_by=None, filters=None):
+        """ Apply common filters, order and limit to query
+
+        Args:
+            query (sqlalchemy.orm.query): SQLAlchemy query object
+
+        Kwargs:
+            count (int): query limit, use zero for no limit
+            since_id (int, optional): only results with id greater than
+            order_by (str): order ascending (asc) or descending (desc)
+            filters (dict, optional): filters for sqlalchemy query
+
+        Returns:
+            The SQLAlchemy query object filtered
+        """
         # only results with id greater than
         if since_id:
             query = query.filter(self.Model.id > since_id)
 
-        # set order
-        if order_by == 'desc':
-            order = self.order_by.desc()
-        elif order_by == 'asc':
-            order = self.order_by.asc()
+        # set order, with id as tiebreaker to keep it stable
+        if order_by in ('asc', 'desc'):
+            columns = [self.order_by]
+            if self.order_by is not self.Model.id:
+                columns.append(self.Model.id)
+
+            order = [getattr(c, order_by)() for c in columns]
         else:
-            order = None
+            order = [None]
 
         # apply filters or not
         if filters is not None:
             query = query.filter_by(**filters)  # smart filter by kwargs
 
-        # do query
-        items = query.order_by(order).limit(count).all()
-        result = items_schema.dump(items).data
+        query = query.order_by(*order)
 
-        return result
+        if count:
+            query = query.limit(count)
+
+        return query
 
     def get_all(self, *args, **kwargs):
         """ Get all items from specified relation
@@ -130,7 +254,7 @@ class BaseService():
         """
         item_schema = self.Schema()
 
-        item = self.Model.query.get(id)
+        item = self.Model.query.options(*self.load_options).get(id)
         result = item_schema.dump(item).data
 
         return result
@@ -156,6 +280,7 @@ class BaseService():
         # commit to database
         db.session.delete(item)
         db.session.commit()
+        invalidate(self.cache_tables)
 
         return True  # destroyed
 
@@ -216,6 +341,7 @@ class TagService(BaseService):
         db.session.add_all(processes)
         db.session.add(tag)
         db.session.commit()
+        invalidate(self.cache_tables)
 
         # get schema to return
         result = item_schema.dump(tag).data
@@ -241,6 +367,21 @@ class TagService(BaseService):
 
         return self.get_query(query, *args, **kwargs)
 
+    @staticmethod
+    def ids_by_process(process_id):
+        """ Get ids of all tags from specified process
+
+        Args:
+            process_id (int): related process id
+
+        Returns:
+            A list of tags ids
+        """
+        query = db.session.query(process_tags.c.tag_id).\
+            filter(process_tags.c.process_id == process_id)
+
+        return [tag_id for tag_id, in query]
+
 
 class RecordService(BaseService):
     """ Record methods with Base Service """
@@ -249,6 +390,180 @@ class RecordService(BaseService):
         super(RecordService, self).__init__(*args, **kwargs)
 
         self.order_by = Record.time_opc  # orverride order by column
+        # new records don't change cached views, only removed ones, so views
+        # of single records, that may not exist yet, are not cached
+        self.cache_tables = [Record.__tablename__]
+        # exported columns, converted by export_row to keys of RecordSchema
+        self.export_keys = ('id', 'quality', 'tag', 'time_db', 'time_opc', 'value')
+        self.export_columns = (
+            Record.id, Record.quality, Record.tag_id, Record.time_db, Record.time_opc,
+            Record.value_double, Record.value_int, Record.value_bool, Record.value_text
+        )
+
+    def get_query(self, query, count=0, since_id=0, order_by=None, filters=None,
+                  export=None, cursor=None):
+        """ Get all records from query or stream it when export format is set
+
+        Args:
+            query (sqlalchemy.orm.query): SQLAlchemy query object
+
+        Kwargs:
+            count (int): query limit, use zero for WIIM_COUNT_LIMIT
+            since_id (int, optional): only results with id greater than
+            order_by (str): order ascending (asc) or descending (desc)
+            filters (dict, optional): filters for sqlalchemy query
+            export (str, optional): stream format, one of EXPORT_FORMATS
+            cursor (str, optional): continuation token from next_cursor,
+                it overrides order_by with the order of the first page
+
+        Returns:
+            A list with table rows data mapped or a generator of text chunks
+        """
+        if cursor is not None:
+            query, order_by = self.after_cursor(query, cursor)
+
+        if export is not None:
+            return self.export(query, export, count, since_id, order_by, filters)
+
+        return super(RecordService, self).get_query(
+            query, count, since_id, order_by, filters)
+
+    @staticmethod
+    def next_cursor(result, order_by):
+        """ Get continuation token for the page after result
+
+        Args:
+            result (list of dict): records page returned by get_query
+            order_by (str): order of the page, asc or desc
+
+        Returns:
+            An opaque token with last (time_opc, id) or None if not paginable
+        """
+        if not result or order_by not in ('asc', 'desc'):
+            return None
+
+        last = result[-1]
+        # remove timezone added by marshmallow, database time is naive
+        time_opc = last['time_opc'].split('+')[0]
+        token = json.dumps([time_opc, last['id'], order_by]).encode()
+
+        return base64.urlsafe_b64encode(token).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """ Get keyset values from continuation token
+
+        Args:
+            cursor (str): token from next_cursor
+
+        Returns:
+            A tuple with time_opc, id and order of the token
+
+        Raises:
+            Exception: If token is invalid
+        """
+        try:
+            time_opc, id, order_by = json.loads(
+                base64.urlsafe_b64decode(cursor.encode()).decode())
+            time_opc = datetime.strptime(
+                time_opc, '%Y-%m-%dT%H:%M:%S.%f' if '.' in time_opc else '%Y-%m-%dT%H:%M:%S')
+            id = int(id)
+        except (ValueError, TypeError):
+            raise Exception('Invalid cursor ' + cursor)
+
+        return time_opc, id, 'desc' if order_by == 'desc' else 'asc'
+
+    def after_cursor(self, query, cursor):
+        """ Filter query by keyset (time_opc, id) after continuation token
+
+        Args:
+            query (sqlalchemy.orm.query): SQLAlchemy query object
+            cursor (str): token from next_cursor
+
+        Returns:
+            A tuple with the filtered query and the order of the token
+        """
+        time_opc, id, order_by = self.decode_cursor(cursor)
+
+        if order_by == 'desc':
+            query = query.filter(or_(
+                Record.time_opc < time_opc,
+                and_(Record.time_opc == time_opc, Record.id < id)
+            ))
+        else:
+            query = query.filter(or_(
+                Record.time_opc > time_opc,
+                and_(Record.time_opc == time_opc, Record.id > id)
+            ))
+
+        return query, order_by
+
+    def export(self, query, fmt, count=0, since_id=0, order_by=None, filters=None):
+        """ Stream records from query using a server-side cursor
+
+        Args:
+            query (sqlalchemy.orm.query): SQLAlchemy query object
+            fmt (str): export format, one of EXPORT_FORMATS
+
+        Kwargs:
+            count (int): query limit, use zero for no limit
+            since_id (int, optional): only results with id greater than
+            order_by (str): order ascending (asc) or descending (desc)
+            filters (dict, optional): filters for sqlalchemy query
+
+        Returns:
+            A generator of text chunks with many lines each
+
+        Raises:
+            Exception: If export format is unknown
+        """
+        if fmt not in EXPORT_FORMATS:
+            raise Exception('Invalid export format ' + str(fmt))
+
+        chunk = app.config['WIIM_EXPORT_CHUNK']
+
+        # fetch only columns without ORM objects, in chunks from server
+        query = self.filter_query(query, count, since_id, order_by, filters).\
+            with_entities(*self.export_columns).\
+            execution_options(stream_results=True).\
+            yield_per(chunk)
+
+        return self._export_lines(query, fmt, self.export_keys, chunk)
+
+    @staticmethod
+    def export_row(row):
+        """ Get exported values from columns row, same as RecordSchema """
+        id, quality, tag_id, time_db, time_opc = row[:5]
+        # only the column of tag data type is filled
+        value = next((v for v in row[5:] if v is not None), None)
+
+        # same datetime format of marshmallow
+        return [id, QUALITY_NAMES.get(quality), tag_id, isoformat(time_db),
+                isoformat(time_opc), value]
+
+    def _export_lines(self, rows, fmt, keys, chunk):
+        """ Generate text chunks from rows in export format """
+        buffer = io.StringIO()
+
+        if fmt == 'csv':
+            writer = csv.writer(buffer)
+            writer.writerow(keys)
+
+        for index, row in enumerate(rows, 1):
+            row = self.export_row(row)
+
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(keys, row))) + '\n')
+
+            # send lines when chunk is complete
+            if index % chunk == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield buffer.getvalue()
 
     def create(self, **kwargs):
         """ Create a new record entry
@@ -262,12 +577,334 @@ class RecordService(BaseService):
         Raises:
             Exception: If have invalid or missing attributes
         """
-        # checks if tag id exits
-        if db.session.query(Tag.id).filter_by(id=kwargs['tag_id']).scalar() is None:
+        # checks if tag id exits and get its data type
+        data_type = db.session.query(Tag.data_type).filter_by(id=kwargs['tag_id']).scalar()
+        if data_type is None:
             raise Exception("Have no Tag with id equal " + str(kwargs['tag_id']))
 
-        # continue with default method
-        return super(RecordService, self).create(**kwargs)
+        item_schema = self.Schema()
+
+        # checks required fields
+        errors = item_schema.validate(kwargs)
+        if errors:
+            raise Exception(errors)
+
+        # create new record with value in column of tag data type
+        try:
+            record = Record(**self.to_columns(kwargs, data_type))
+        except (ValueError, TypeError, OverflowError):
+            raise Exception({'value': ['Not a valid {}.'.format(data_type)]})
+
+        # write record and last record of tag together
+        db.session.add(record)
+        db.session.flush()
+        time_opc = parse_time(record.time_opc)
+        self.update_latest(record.id, time_opc, time_opc)
+        rollup_service.defer([(record.tag_id, record.time_opc)])
+        db.session.commit()
+        record_feed.notify()
+
+        # get schema to return
+        result = item_schema.dump(record).data
+
+        return result  # created
+
+    def create_many(self, records, dedupe=False):
+        """ Create many record entries with a single insert
+
+        Args:
+            records (list of dict): records attributes, each one with tag_id
+
+        Kwargs:
+            dedupe (bool): skip records with tag_id and time_opc already
+                stored or repeated in batch, to replay batches safely
+
+        Returns:
+            A dict with created count, duplicates count and a list of per-item errors
+
+        Raises:
+            Exception: If records is not a list or exceeds WIIM_BATCH_LIMIT
+        """
+        if not isinstance(records, list):
+            raise Exception('Require a list of Records')
+
+        if len(records) > app.config['WIIM_BATCH_LIMIT']:
+            raise Exception('Batch exceeds limit of {} Records'.format(
+                app.config['WIIM_BATCH_LIMIT']))
+
+        # checks required fields of all items without build models
+        errors = self.Schema(many=True).validate(records)
+
+        # checks if tag ids exists and get data types with only one query
+        tag_ids = {r['tag_id'] for r in records
+                   if isinstance(r, dict) and isinstance(r.get('tag_id'), int)}
+        data_types = dict(
+            db.session.query(Tag.id, Tag.data_type).filter(Tag.id.in_(tag_ids))
+        ) if tag_ids else {}
+
+        rows = []
+        result = {'created': 0, 'duplicates': 0, 'errors': []}
+
+        for index, record in enumerate(records):
+            if not isinstance(record, dict):
+                result['errors'].append({'index': index, 'messages': {
+                    '_schema': ['Invalid input type.']
+                }})
+                continue
+
+            if index in errors:
+                result['errors'].append({'index': index, 'messages': errors[index]})
+                continue
+
+            tag_id = record.get('tag_id')
+            if not isinstance(tag_id, int) or tag_id not in data_types:
+                result['errors'].append({'index': index, 'messages': {
+                    'tag_id': ['Have no Tag with id equal ' + str(tag_id)]
+                }})
+                continue
+
+            try:
+                rows.append(self.to_columns(record, data_types[tag_id]))
+            except (ValueError, TypeError, OverflowError):
+                result['errors'].append({'index': index, 'messages': {
+                    'value': ['Not a valid {}.'.format(data_types[tag_id])]
+                }})
+
+        if dedupe and rows:
+            unique = self.unique_rows(rows)
+            result['duplicates'] = len(rows) - len(unique)
+            rows = unique
+
+        # insert all valid rows as one multi-row statement and commit once
+        if rows:
+            inserted = db.session.execute(Record.__table__.insert().values(rows))
+            times = [parse_time(r['time_opc']) for r in rows]
+            # mysql returns the id of first row from multi-row insert
+            self.update_latest(inserted.lastrowid, min(times), max(times))
+            rollup_service.update((r['tag_id'], r['time_opc']) for r in rows)
+            db.session.commit()
+            record_feed.notify()
+
+        result['created'] = len(rows)
+
+        return result
+
+    @staticmethod
+    def unique_rows(rows):
+        """ Get rows without the ones already stored or repeated
+
+        Args:
+            rows (list of dict): record table columns
+
+        Returns:
+            A list with rows of tag_id and time_opc pairs not stored, first of each pair
+        """
+        times = [parse_time(row['time_opc']) for row in rows]
+
+        # time span of rows by tag
+        spans = {}
+        RollupService.add_spans(spans, ((row['tag_id'], time) for row, time in zip(rows, times)))
+
+        # stored pairs in time span of each tag, by tag and time index
+        stored = set(db.session.query(Record.tag_id, Record.time_opc).filter(or_(*(
+            and_(Record.tag_id == tag_id, Record.time_opc.between(start, end))
+            for tag_id, (start, end) in spans.items()
+        ))))
+
+        unique = []
+        for row, time in zip(rows, times):
+            key = (row['tag_id'], time)
+            if key not in stored:
+                stored.add(key)
+                unique.append(row)
+
+        return unique
+
+    @staticmethod
+    def to_columns(record, data_type):
+        """ Get record table columns from validated record attributes
+
+        Args:
+            record (dict): record attributes with value and quality name or code
+            data_type (str): tag data type, one of DATA_TYPES
+
+        Returns:
+            A dict with all columns, except id, and its values
+
+        Raises:
+            ValueError: If value can not be converted to data type, without
+                losing its fraction, or is not a finite number
+            TypeError: If value is not a number, string or boolean
+            OverflowError: If value is a number too big for its column
+        """
+        value = record['value']
+
+        # lists and objects are not values, even for strings
+        if not isinstance(value, (str, int, float)):
+            raise TypeError(value)
+
+        if data_type == 'double':
+            value = float(value)
+            if not math.isfinite(value):
+                raise ValueError(value)
+        elif data_type == 'int':
+            if isinstance(value, float) and not value.is_integer():
+                raise ValueError(value)
+            value = int(value)
+            if not BIGINT_MIN <= value <= BIGINT_MAX:
+                raise OverflowError(value)
+        elif data_type == 'bool' and isinstance(value, str):
+            if value.lower() not in ('true', 'false', '1', '0'):
+                raise ValueError(value)
+            value = value.lower() in ('true', '1')
+        elif data_type == 'bool':
+            value = bool(value)
+        else:
+            value = str(value)
+            if len(value) > Record.value_text.type.length:
+                raise ValueError(value)
+
+        columns = {c: None for c in DATA_TYPES.values()}
+        columns[DATA_TYPES[data_type]] = value
+        columns.update({
+            'tag_id': record['tag_id'],
+            'time_opc': record['time_opc'],
+            # database time when not defined by collector
+            'time_db': record.get('time_db') or func.current_timestamp(),
+            'quality': quality_code(record['quality']),
+        })
+
+        return columns
+
+    @staticmethod
+    def update_latest(first_id, start, end):
+        """ Set last record of tags with records inserted from first id
+
+        Records are searched only in the partitions of the inserted ones, by
+        their time span.
+
+        Args:
+            first_id (int): id of first record inserted
+            start (datetime): time_opc of the oldest record inserted
+            end (datetime): time_opc of the newest record inserted
+        """
+        table = TagLatest.__table__
+        # stored times are rounded to milliseconds
+        span = Record.time_opc.between(start - timedelta(seconds=1), end + timedelta(seconds=1))
+
+        # last record id of each tag since first inserted
+        last = db.session.query(Record.tag_id, func.max(Record.id).label('id')).\
+            filter(Record.id >= first_id, span).\
+            group_by(Record.tag_id).subquery()
+
+        # and its time
+        rows = db.session.query(Record.tag_id, Record.id, Record.time_opc).\
+            join(last, Record.id == last.c.id).\
+            filter(span)
+
+        # insert or keep the greatest between old and new id, with time of the kept one
+        stmt = mysql.insert(table).from_select(
+            ['tag_id', 'record_id', 'time_opc'], rows.statement)
+        stmt = stmt.on_duplicate_key_update(
+            record_id=literal_column('GREATEST(tag_latest.record_id, VALUES(record_id))'),
+            # right whether record_id is updated before or after it
+            time_opc=literal_column('IF(VALUES(record_id) >= tag_latest.record_id, '
+                                    'VALUES(time_opc), tag_latest.time_opc)'))
+
+        db.session.execute(stmt)
+
+    def latest(self, tags=None):
+        """ Get state of last records of tags, it changes with their new records
+
+        Kwargs:
+            tags (list of int, optional): only last records of these tags, None for all
+
+        Returns:
+            A tuple with count and sum of last records ids and unix timestamp of
+            the newest database time, None when there are no records
+        """
+        if tags is not None and not tags:
+            return 0, None, None
+
+        query = db.session.query(
+            func.count(), func.sum(TagLatest.record_id),
+            # time_db is read in session time zone, unix timestamp is UTC
+            func.max(func.unix_timestamp(Record.time_db))
+        ).select_from(TagLatest).\
+            join(Record, and_(Record.id == TagLatest.record_id,
+                              Record.time_opc == TagLatest.time_opc))
+
+        if tags is not None:
+            query = query.filter(TagLatest.tag_id.in_(tags))
+
+        return query.one()
+
+    def get_by_id(self, id, time_opc=None):
+        """ Get single record by id
+
+        Args:
+            id (int): Record id to query
+
+        Kwargs:
+            time_opc (datetime or str, optional): record time, to read only its
+                partition instead of all
+
+        Returns:
+            A dict with table row data mapped
+        """
+        item_schema = self.Schema()
+
+        query = Record.query.options(*self.load_options).filter(Record.id == id)
+        if time_opc:
+            query = query.filter(Record.time_opc == parse_time(time_opc))
+
+        result = item_schema.dump(query.first()).data
+
+        return result
+
+    def destroy_by_id(self, id, time_opc=None):
+        """ Remove a record entry by id and update last record of the tag
+
+        keyword arguments:
+            id (int): Record id to remove
+            time_opc (datetime or str, optional): record time, to read only its
+                partition instead of all
+
+        Returns:
+            True if it was a success
+
+        Raises:
+            Exception: If there is no record with id
+        """
+        query = Record.query.filter(Record.id == id)
+        if time_opc:
+            query = query.filter(Record.time_opc == parse_time(time_opc))
+
+        record = query.first()
+        if record is None:
+            raise Exception('Have no Record with id equal ' + str(id))
+
+        # by whole primary key, from its partition
+        Record.query.filter(Record.id == record.id, Record.time_opc == record.time_opc).\
+            delete(synchronize_session=False)
+
+        # replace last record by the previous one or remove it
+        latest = TagLatest.query.get(record.tag_id)
+        if latest is not None and latest.record_id == record.id:
+            previous = db.session.query(Record.id, Record.time_opc).\
+                filter(Record.tag_id == record.tag_id,
+                       Record.time_opc <= record.time_opc).\
+                order_by(Record.time_opc.desc(), Record.id.desc()).first()
+
+            if previous is None:
+                db.session.delete(latest)
+            else:
+                latest.record_id, latest.time_opc = previous
+
+        db.session.commit()
+        invalidate(self.cache_tables)
+
+        return True  # destroyed
 
     def get_by_process(self, process_id, *args, **kwargs):
         """ Get all tags from specified process
@@ -280,17 +917,30 @@ class RecordService(BaseService):
             since_id (int, optional): only results with id greater than
             order_by (str): order ascending (asc) or descending (desc)
             filters (dict, optional): filters for sqlalchemy query
+            export (str, optional): stream format, one of EXPORT_FORMATS
+            cursor (str, optional): continuation token from next_cursor
 
         Returns:
-            A list with table rows data mapped, every row is a dict
+            A list with table rows data mapped or a generator of text chunks
         """
+        query = self.query_by_process(process_id)
 
+        return self.get_query(query, *args, **kwargs)
+
+    @staticmethod
+    def query_by_process(process_id):
+        """ Query of all records from specified process
+
+        Args:
+            process_id (int): related process id
+
+        Returns:
+            The SQLAlchemy query object
+        """
         # get tags by process id
         t = Tag.query.filter(Tag.processes.any(Process.id == process_id)).subquery('t')
         # query records grouping by tag id with previous tags
-        query = Record.query.filter(Record.tag_id == t.c.id)
-
-        return self.get_query(query, *args, **kwargs)
+        return Record.query.filter(Record.tag_id == t.c.id)
 
     def get_by_tags(self, tags, *args, **kwargs):
         """ Get all records from a tags list
@@ -307,11 +957,521 @@ class RecordService(BaseService):
         Returns:
             A list with table rows data mapped, every row is a dict
         """
+        query = self.query_by_tags(tags)
 
+        return self.get_query(query, *args, **kwargs)
+
+    @staticmethod
+    def query_by_tags(tags):
+        """ Query of all records from a tags list
+
+        Args:
+            tags (list of int): list or tuple with related tags id
+
+        Returns:
+            The SQLAlchemy query object
+        """
         # get records with tags id
-        query = Record.query.filter(Record.tag_id.in_(tags))
+        return Record.query.filter(Record.tag_id.in_(tags))
 
-        return self.get_query(query, *args, **kwargs)
+    def interpolate(self, tag_id, start=None, end=None, step=60):
+        """ Get values of tag at regular times, interpolated between stored records
+
+        Compressed history keeps only the records needed to rebuild the signal,
+        so numeric values are linear between the records before and after each
+        time, with the worst quality of both. Other values hold the record
+        before. Times without record before are skipped.
+
+        Args:
+            tag_id (int): related tag id
+
+        Kwargs:
+            start (datetime or str, optional): window start, default is one day before end
+            end (datetime or str, optional): window end, default is now
+            step (float): seconds between times
+
+        Returns:
+            A list of dicts with tag, time_opc, value and quality
+
+        Raises:
+            Exception: If step is invalid or gives more than WIIM_ROLLUP_LIMIT times
+        """
+        end = parse_time(end) if end else datetime.utcnow()
+        start = parse_time(start) if start else end - timedelta(days=1)
+
+        try:
+            step = float(step)
+        except ValueError:
+            step = 0
+
+        if not math.isfinite(step) or step <= 0:
+            raise Exception('Invalid interpolation step ' + str(step))
+
+        points = int((end - start).total_seconds() // step) + 1
+        if points > app.config['WIIM_ROLLUP_LIMIT']:
+            raise Exception('Interpolation exceeds limit of {} points'.format(
+                app.config['WIIM_ROLLUP_LIMIT']))
+
+        columns = (Record.time_opc, Record.quality,
+                   Record.value_double, Record.value_int, Record.value_bool, Record.value_text)
+        forward = (Record.time_opc, Record.id)
+        times = [start + timedelta(seconds=index * step) for index in range(points)]
+
+        # only the records before and after each time, by index lookups
+        nearest = {}
+        for first in range(0, points, INTERPOLATE_CHUNK):
+            selects = []
+
+            for index in range(first, min(first + INTERPOLATE_CHUNK, points)):
+                for side, condition, order in (
+                        ('before', Record.time_opc <= times[index], [c.desc() for c in forward]),
+                        ('after', Record.time_opc > times[index], forward)):
+                    record = db.session.query(
+                        literal_column(str(index)).label('point'),
+                        literal_column("'{}'".format(side)).label('side'),
+                        *columns
+                    ).filter(Record.tag_id == tag_id, condition)\
+                        .order_by(*order).limit(1).subquery()
+                    selects.append(select([record]))
+
+            for row in db.session.execute(union_all(*selects)):
+                nearest[(row.point, row.side)] = row
+
+        result = []
+
+        for index, time in enumerate(times):
+            before, after = nearest.get((index, 'before')), nearest.get((index, 'after'))
+
+            if before is None:
+                continue
+
+            value, quality = Record.value.fget(before), before.quality
+
+            if after is not None:
+                next_value = Record.value.fget(after)
+                # numbers, not booleans
+                if type(value) in (int, float) and type(next_value) in (int, float):
+                    ratio = (time - before.time_opc).total_seconds() / \
+                        (after.time_opc - before.time_opc).total_seconds()
+                    value += (next_value - value) * ratio
+                    quality = max(quality, after.quality)
+
+            result.append({
+                'tag': tag_id,
+                'time_opc': isoformat(time),
+                'value': value,
+                'quality': QUALITY_NAMES.get(quality),
+            })
+
+        return result
+
+
+class RollupService():
+    """ Rollup methods to accelerate trends over long time windows
+
+    Rollups of one minute are computed from records and each coarser
+    resolution from the previous one, so only buckets with new records
+    are recomputed and a recompute is always complete, never additive.
+    """
+
+    # rollups of finest resolution from numeric records, first and last values
+    # read from the records at the first and last times of each bucket
+    RECORD_SQL = (
+        "INSERT INTO record_rollup "
+        "(tag_id, resolution, bucket, count, sum, min, max, first, last) "
+        "SELECT g.tag_id, :resolution, g.b, g.n, g.s, g.lo, g.hi, "
+        "(SELECT COALESCE(value_double, value_int, value_bool) FROM record "
+        "WHERE tag_id = g.tag_id AND time_opc = g.t0 AND ({conditions}) "
+        "AND COALESCE(value_double, value_int, value_bool) IS NOT NULL "
+        "ORDER BY id LIMIT 1), "
+        "(SELECT COALESCE(value_double, value_int, value_bool) FROM record "
+        "WHERE tag_id = g.tag_id AND time_opc = g.t1 AND ({conditions}) "
+        "AND COALESCE(value_double, value_int, value_bool) IS NOT NULL "
+        "ORDER BY id DESC LIMIT 1) "
+        "FROM (SELECT tag_id, "
+        "TIMESTAMPADD(SECOND, FLOOR(TIMESTAMPDIFF(SECOND, :epoch, time_opc) / :resolution) "
+        "* :resolution, :epoch) AS b, "
+        "COUNT(*) AS n, SUM(v) AS s, MIN(v) AS lo, MAX(v) AS hi, "
+        "MIN(time_opc) AS t0, MAX(time_opc) AS t1 "
+        "FROM (SELECT tag_id, time_opc, COALESCE(value_double, value_int, value_bool) AS v "
+        "FROM record WHERE {conditions}) AS r "
+        "WHERE v IS NOT NULL "
+        "GROUP BY tag_id, b) AS g "
+        "ON DUPLICATE KEY UPDATE count = VALUES(count), sum = VALUES(sum), "
+        "min = VALUES(min), max = VALUES(max), first = VALUES(first), last = VALUES(last)"
+    )
+
+    # rollups of coarser resolution from previous one, first and last values
+    # read from the first and last source buckets
+    ROLLUP_SQL = (
+        "INSERT INTO record_rollup "
+        "(tag_id, resolution, bucket, count, sum, min, max, first, last) "
+        "SELECT g.tag_id, :resolution, g.b, g.n, g.s, g.lo, g.hi, "
+        "(SELECT first FROM record_rollup "
+        "WHERE tag_id = g.tag_id AND resolution = :source AND bucket = g.t0), "
+        "(SELECT last FROM record_rollup "
+        "WHERE tag_id = g.tag_id AND resolution = :source AND bucket = g.t1) "
+        "FROM (SELECT tag_id, "
+        "TIMESTAMPADD(SECOND, FLOOR(TIMESTAMPDIFF(SECOND, :epoch, bucket) / :resolution) "
+        "* :resolution, :epoch) AS b, "
+        "SUM(count) AS n, SUM(sum) AS s, MIN(min) AS lo, MAX(max) AS hi, "
+        "MIN(bucket) AS t0, MAX(bucket) AS t1 "
+        "FROM record_rollup "
+        "WHERE resolution = :source AND ({conditions}) "
+        "GROUP BY tag_id, b) AS g "
+        "ON DUPLICATE KEY UPDATE count = VALUES(count), sum = VALUES(sum), "
+        "min = VALUES(min), max = VALUES(max), first = VALUES(first), last = VALUES(last)"
+    )
+
+    # pending span of tag extended by new records
+    PENDING_SQL = (
+        "INSERT INTO rollup_pending (tag_id, time_start, time_end) "
+        "VALUES (:tag_id, :start, :end) "
+        "ON DUPLICATE KEY UPDATE time_start = LEAST(time_start, VALUES(time_start)), "
+        "time_end = GREATEST(time_end, VALUES(time_end)), version = version + 1"
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.order_by = Rollup.bucket
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @staticmethod
+    def bucket(time, resolution):
+        """ Get start time of bucket that contains time
+
+        Args:
+            time (datetime): time inside bucket
+            resolution (int): bucket size in seconds
+
+        Returns:
+            A datetime with bucket start
+        """
+        seconds = (time - ROLLUP_EPOCH).total_seconds()
+
+        return ROLLUP_EPOCH + timedelta(seconds=seconds // resolution * resolution)
+
+    @staticmethod
+    def add_spans(spans, samples):
+        """ Extend time spans by tag with samples
+
+        Args:
+            spans (dict): tag id to tuple of first and last times, changed in place
+            samples (iterable): tuples of tag id and record time_opc
+        """
+        for tag_id, time in samples:
+            time = parse_time(time)
+            start, end = spans.get(tag_id, (time, time))
+            spans[tag_id] = (min(start, time), max(end, time))
+
+    def update(self, samples):
+        """ Recompute rollups of buckets with new records
+
+        Args:
+            samples (iterable): tuples of tag id and record time_opc
+        """
+        spans = {}
+        self.add_spans(spans, samples)
+        self.update_spans(spans)
+
+    def update_spans(self, spans):
+        """ Recompute rollups of buckets in time spans
+
+        Args:
+            spans (dict): tag id to tuple of first and last times of new records
+        """
+        if not spans:
+            return
+
+        sql, column, source = self.RECORD_SQL, 'time_opc', None
+
+        for name, resolution in ROLLUP_RESOLUTIONS:
+            params = {'resolution': resolution, 'source': source, 'epoch': ROLLUP_EPOCH}
+            conditions = []
+
+            # buckets between first and last new records of each tag
+            for index, (tag_id, (start, end)) in enumerate(spans.items()):
+                params['tag{}'.format(index)] = tag_id
+                params['start{}'.format(index)] = self.bucket(start, resolution)
+                params['end{}'.format(index)] = self.bucket(end, resolution) + \
+                    timedelta(seconds=resolution)
+                conditions.append(
+                    '(tag_id = :tag{0} AND {1} >= :start{0} AND {1} < :end{0})'.format(
+                        index, column))
+
+            db.session.execute(sql.format(conditions=' OR '.join(conditions)), params)
+
+            sql, column, source = self.ROLLUP_SQL, 'bucket', resolution
+
+    def defer(self, samples):
+        """ Recompute rollups of buckets with new records later, in a single update
+
+        Spans of records are merged in the rollup_pending table, in the
+        caller transaction, and updated by a thread every WIIM_ROLLUP_INTERVAL
+        seconds, so single inserts don't recompute rollups each. Spans left
+        by a stop are updated by the thread of the next process inserting
+        records. Zero interval updates now, in the caller transaction.
+
+        Args:
+            samples (iterable): tuples of tag id and record time_opc
+        """
+        if not app.config['WIIM_ROLLUP_INTERVAL']:
+            return self.update(samples)
+
+        spans = {}
+        self.add_spans(spans, samples)
+        if not spans:
+            return
+
+        # same order of rows locks in every transaction
+        db.session.execute(self.PENDING_SQL, [
+            {'tag_id': tag_id, 'start': start, 'end': end}
+            for tag_id, (start, end) in sorted(spans.items())])
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, args=(app._get_current_object(),), daemon=True)
+                self.thread.start()
+
+    def update_pending(self):
+        """ Recompute rollups of pending spans and remove them
+
+        Spans extended while updating are kept for the next update.
+
+        Returns:
+            Number of spans updated
+        """
+        pending = db.session.query(
+            RollupPending.tag_id, RollupPending.time_start, RollupPending.time_end,
+            RollupPending.version).all()
+
+        if not pending:
+            return 0
+
+        self.update_spans({tag_id: (start, end) for tag_id, start, end, _ in pending})
+
+        for tag_id, _, _, version in pending:
+            RollupPending.query.filter_by(tag_id=tag_id, version=version).\
+                delete(synchronize_session=False)
+
+        db.session.commit()
+
+        return len(pending)
+
+    def run(self, app):
+        """ Deferred updates thread loop, failed spans are retried with the next ones """
+        while True:
+            time.sleep(app.config['WIIM_ROLLUP_INTERVAL'])
+
+            with app.app_context():
+                try:
+                    self.update_pending()
+                except Exception:
+                    app.logger.exception('Rollup update failed')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    @staticmethod
+    def auto_resolution(start, end, points):
+        """ Get coarsest resolution with at least points buckets in time window
+
+        Args:
+            start (datetime): window start
+            end (datetime): window end
+            points (int): requested number of points
+
+        Returns:
+            Resolution in seconds, the finest when none have enough points
+        """
+        span = (end - start).total_seconds()
+
+        for name, resolution in reversed(ROLLUP_RESOLUTIONS):
+            if span / resolution >= points:
+                return resolution
+
+        return ROLLUP_RESOLUTIONS[0][1]
+
+    def get_by_tag(self, tag_id, start=None, end=None, resolution='auto', points=0,
+                   count=0, order_by=None):
+        """ Get rollups of tag in time window
+
+        Args:
+            tag_id (int): related tag id
+
+        Kwargs:
+            start (datetime or str, optional): window start, default is one day before end
+            end (datetime or str, optional): window end, default is now
+            resolution (str): one of ROLLUP_RESOLUTIONS names or auto
+            points (int): requested number of points for auto, zero for WIIM_ROLLUP_POINTS
+            count (int): query limit, use zero for WIIM_ROLLUP_LIMIT
+            order_by (str): order ascending (asc) or descending (desc)
+
+        Returns:
+            A list with rollups data mapped, every row is a dict
+
+        Raises:
+            Exception: If resolution is unknown
+        """
+        items_schema = RollupSchema(many=True)
+
+        end = parse_time(end) if end else datetime.utcnow()
+        start = parse_time(start) if start else end - timedelta(days=1)
+
+        if resolution == 'auto':
+            resolution = self.auto_resolution(
+                start, end, points or app.config['WIIM_ROLLUP_POINTS'])
+        elif resolution in dict(ROLLUP_RESOLUTIONS):
+            resolution = dict(ROLLUP_RESOLUTIONS)[resolution]
+        else:
+            raise Exception('Invalid resolution ' + str(resolution))
+
+        # limit fetch quantity
+        if not count or count > app.config['WIIM_ROLLUP_LIMIT']:
+            count = app.config['WIIM_ROLLUP_LIMIT']
+
+        # buckets of window, including the one where window starts
+        query = Rollup.query.filter(
+            Rollup.tag_id == tag_id,
+            Rollup.resolution == resolution,
+            Rollup.bucket >= self.bucket(start, resolution),
+            Rollup.bucket < end
+        )
+
+        order = self.order_by.desc() if order_by == 'desc' else self.order_by.asc()
+        items = query.order_by(order).limit(count).all()
+        result = items_schema.dump(items).data
+
+        return result
+
+
+class AggregateService():
+    """ Aggregate methods to compute tags statistics inside database """
+
+    # available functions over numeric values
+    FUNCTIONS = {
+        'avg': func.avg,
+        'min': func.min,
+        'max': func.max,
+        'sum': func.sum,
+        'count': func.count,
+        'stddev': func.stddev_pop,
+    }
+
+    # bucket units suffixes in seconds
+    UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+    @classmethod
+    def parse_bucket(cls, bucket):
+        """ Get bucket size in seconds from string like 30s, 5m, 1h or 1d
+
+        Raises:
+            Exception: If bucket is invalid
+        """
+        try:
+            seconds = int(bucket[:-1]) * cls.UNITS[bucket[-1]]
+        except (ValueError, KeyError, IndexError):
+            raise Exception('Invalid bucket ' + str(bucket))
+
+        if seconds <= 0:
+            raise Exception('Invalid bucket ' + str(bucket))
+
+        return seconds
+
+    def aggregate(self, condition, start=None, end=None, functions=None, bucket=None):
+        """ Get aggregates of numeric records of tags by time bucket
+
+        Args:
+            condition (sqlalchemy expression): filter of record tags
+
+        Kwargs:
+            start (datetime or str, optional): window start, default is one day before end
+            end (datetime or str, optional): window end, default is now
+            functions (list of str, optional): names from FUNCTIONS, default is avg
+            bucket (str, optional): bucket size like 5m, default is whole window
+
+        Returns:
+            A list of dicts with tag, bucket start and value of each function
+
+        Raises:
+            Exception: If function or bucket are invalid
+        """
+        functions = functions or ['avg']
+        for name in functions:
+            if name not in self.FUNCTIONS:
+                raise Exception('Invalid function ' + str(name))
+
+        end = parse_time(end) if end else datetime.utcnow()
+        start = parse_time(start) if start else end - timedelta(days=1)
+
+        # numeric value of tag data type
+        value = func.coalesce(Record.value_double, Record.value_int, Record.value_bool)
+
+        if bucket:
+            seconds = self.parse_bucket(bucket)
+            time = func.timestampadd(
+                literal_column('SECOND'),
+                func.floor(func.timestampdiff(literal_column('SECOND'), ROLLUP_EPOCH,
+                                              Record.time_opc) / seconds) * seconds,
+                ROLLUP_EPOCH
+            )
+        else:
+            time = literal_column("'{:%Y-%m-%d %H:%M:%S}'".format(start))
+
+        query = db.session.query(
+            Record.tag_id,
+            time.label('bucket'),
+            *[self.FUNCTIONS[name](value).label(name) for name in functions]
+        ).filter(
+            condition,
+            Record.time_opc >= start,
+            Record.time_opc < end,
+            value.isnot(None)
+        ).group_by(Record.tag_id, text('bucket')).\
+            order_by(Record.tag_id, text('bucket')).\
+            limit(app.config['WIIM_AGGREGATE_LIMIT'])
+
+        result = []
+        for row in query:
+            item = {'tag': row.tag_id, 'bucket': isoformat(parse_time(row.bucket))}
+            for name in functions:
+                v = getattr(row, name)
+                item[name] = v if v is None or name == 'count' else float(v)
+            result.append(item)
+
+        return result
+
+    def get_by_tags(self, tags, *args, **kwargs):
+        """ Get aggregates of records from a tags list
+
+        Args:
+            tags (list of int): list or tuple with related tags id
+
+        Kwargs:
+            same of aggregate
+
+        Returns:
+            A list of dicts with tag, bucket start and value of each function
+        """
+        return self.aggregate(Record.tag_id.in_(tags), *args, **kwargs)
+
+    def get_by_process(self, process_id, *args, **kwargs):
+        """ Get aggregates of records from all tags of process
+
+        Args:
+            process_id (int): related process id
+
+        Kwargs:
+            same of aggregate
+
+        Returns:
+            A list of dicts with tag, bucket start and value of each function
+        """
+        tags = db.session.query(process_tags.c.tag_id).\
+            filter(process_tags.c.process_id == process_id)
+
+        return self.aggregate(Record.tag_id.in_(tags.subquery()), *args, **kwargs)
 
 
 class TimelineService():
@@ -319,6 +1479,9 @@ class TimelineService():
 
     def __init__(self, *args, **kwargs):
         self.order_by = Tag.id
+        # row serializers of tag and record selected together
+        self.tag_serializer = RowSerializer(Tag, TagSchema, prefix='tag_')
+        self.record_serializer = RowSerializer(Record, RecordSchema, prefix='record_')
 
     def timeline(self, process_id, count=0, since_id=0, order_by=None, filters=None):
         """ Get all tags and last records from specified process
@@ -335,17 +1498,7 @@ class TimelineService():
         Returns:
             A list with tuple of tag and record tables rows data mapped
         """
-
-        # get the last record id from tags
-        r2 = db.session.query(
-            func.max(Record.id).label('max_id')
-        ).group_by(Record.tag_id).subquery('r2')
-
-        # select from tag and record table and combine it
-        query = db.session.query(Record, Tag).\
-            join(r2, r2.c.max_id == Record.id).\
-            filter(Tag.id == Record.tag_id).\
-            filter(Tag.processes.any(Process.id == process_id))
+        query = self.timeline_query(process_id)
 
         timeline_schema = TimelineSchema(many=True)
 
@@ -369,7 +1522,17 @@ class TimelineService():
         if filters is not None:
             query = query.filter_by(**filters)  # smart filter by kwargs
 
-        items = query.order_by(order).limit(count).all()  # do query
+        # only exposed columns without models, when enabled
+        if app.config['WIIM_FAST_SERIALIZE']:
+            rows = query.with_entities(
+                *(self.tag_serializer.columns + self.record_serializer.columns)
+            ).order_by(order).limit(count).all()
+
+            return [{'tag': self.tag_serializer.serialize(row),
+                     'record': self.record_serializer.serialize(row)} for row in rows]
+
+        # do query, with servers of tags dumped by schema
+        items = query.options(joinedload(Tag.server)).order_by(order).limit(count).all()
 
         # convert (tag, record) to dict and add label
         items = [{'tag': t, 'record': r} for r, t in items]
@@ -381,12 +1544,227 @@ class TimelineService():
 
         return result
 
+    @staticmethod
+    def timeline_query(process_id):
+        """ Query of all tags and last records from specified process
+
+        Args:
+            process_id (int): related process id
+
+        Returns:
+            The SQLAlchemy query object with (record, tag) rows
+        """
+        # select tags of process with its last record
+        return db.session.query(Record, Tag).\
+            select_from(TagLatest).\
+            join(Tag, Tag.id == TagLatest.tag_id).\
+            join(Record, and_(Record.id == TagLatest.record_id,
+                              Record.time_opc == TagLatest.time_opc)).\
+            filter(Tag.processes.any(Process.id == process_id))
+
+
+class RetentionService():
+    """ Record partitions and retention methods
+
+    Record table is partitioned by range of time_opc, one partition per
+    month or day (WIIM_RECORD_PARTITION) and a last one named pmax, so
+    expired records are removed dropping whole partitions.
+    """
+
+    def partitions(self):
+        """ Get record table partitions
+
+        Returns:
+            A list with tuples of partition name and upper bound datetime,
+            bound is None for the pmax partition
+        """
+        rows = db.session.execute(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+            "FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'record' "
+            "AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION"
+        )
+
+        result = []
+        for name, bound in rows:
+            if bound == 'MAXVALUE':
+                result.append((name, None))
+            else:
+                result.append((name, datetime.strptime(bound.strip("'"), '%Y-%m-%d %H:%M:%S')))
+
+        return result
+
+    @staticmethod
+    def next_bound(bound):
+        """ Get upper bound of the partition after bound
+
+        Args:
+            bound (datetime): upper bound of previous partition
+
+        Returns:
+            A tuple with the partition name and its upper bound
+        """
+        if app.config['WIIM_RECORD_PARTITION'] == 'day':
+            name = bound.strftime('p%Y%m%d')
+            bound = bound + timedelta(days=1)
+        else:
+            name = bound.strftime('p%Y%m')
+            bound = (bound.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+        return name, bound
+
+    def extend(self, until):
+        """ Create partitions splitting pmax up to until
+
+        Args:
+            until (datetime): last time that needs its own partition
+
+        Returns:
+            A list with created partitions names
+        """
+        bounds = [b for n, b in self.partitions() if b is not None]
+        if not bounds:
+            # first partition starts at current period
+            bound = until.replace(hour=0, minute=0, second=0, microsecond=0)
+            if app.config['WIIM_RECORD_PARTITION'] != 'day':
+                bound = bound.replace(day=1)
+        else:
+            bound = bounds[-1]
+
+        created = []
+        while bound <= until:
+            name, bound = self.next_bound(bound)
+            created.append("PARTITION {} VALUES LESS THAN ('{:%Y-%m-%d %H:%M:%S}')".format(
+                name, bound))
+
+        if created:
+            db.session.execute(
+                "ALTER TABLE record REORGANIZE PARTITION pmax INTO ({}, "
+                "PARTITION pmax VALUES LESS THAN (MAXVALUE))".format(', '.join(created)))
+
+        return [c.split()[1] for c in created]
+
+    def drop_expired(self, cutoff):
+        """ Drop partitions with all records older than cutoff
+
+        Args:
+            cutoff (datetime): records older than it are expired
+
+        Returns:
+            A list with dropped partitions names
+        """
+        expired = [n for n, b in self.partitions() if b is not None and b <= cutoff]
+
+        if expired:
+            db.session.execute('ALTER TABLE record DROP PARTITION ' + ', '.join(expired))
+            self.clean_latest()
+
+        return expired
+
+    def prune_tags(self, cutoffs):
+        """ Delete old records of tags with shorter retention
+
+        Args:
+            cutoffs (dict): tag id and time before which records are deleted
+
+        Returns:
+            Number of records deleted
+        """
+        batch = app.config['WIIM_RETENTION_BATCH']
+        deleted = 0
+
+        for tag_id, cutoff in cutoffs.items():
+            # small batches to not lock table for a long time
+            while True:
+                count = db.session.execute(
+                    'DELETE FROM record WHERE tag_id = :tag_id AND time_opc < :cutoff '
+                    'LIMIT :batch',
+                    {'tag_id': tag_id, 'cutoff': cutoff, 'batch': batch}
+                ).rowcount
+                db.session.commit()
+                deleted += count
+
+                if count < batch:
+                    break
+
+        if deleted:
+            self.clean_latest()
+
+        return deleted
+
+    @staticmethod
+    def clean_latest():
+        """ Remove last records of tags that were deleted """
+        db.session.execute(
+            'DELETE tag_latest FROM tag_latest '
+            'LEFT JOIN record ON record.id = tag_latest.record_id '
+            'AND record.time_opc = tag_latest.time_opc '
+            'WHERE record.id IS NULL'
+        )
+        db.session.commit()
+
+    def retention(self, now):
+        """ Get retention cutoffs of partitions and tags
+
+        Args:
+            now (datetime): current time
+
+        Returns:
+            A tuple with partitions cutoff, None to keep all partitions,
+            and a dict with cutoffs of tags with shorter retention
+        """
+        default = app.config['WIIM_RETENTION_DAYS']
+
+        # tag retention, or server retention, or default
+        tags = {
+            id: tag_days or server_days or default
+            for id, tag_days, server_days in db.session.query(
+                Tag.id, Tag.retention, Server.retention).join(Server)
+        }
+
+        days = list(tags.values()) or [default]
+        if None in days:
+            return None, {
+                id: now - timedelta(days=d) for id, d in tags.items() if d is not None}
+
+        # partitions keep records of tags with longest retention
+        longest = max(days)
+
+        return now - timedelta(days=longest), {
+            id: now - timedelta(days=d) for id, d in tags.items() if d < longest}
+
+    def apply(self, now):
+        """ Create next partitions and remove expired records
+
+        Args:
+            now (datetime): current time
+
+        Returns:
+            A dict with created and dropped partitions and deleted records
+        """
+        created = self.extend(now + timedelta(days=app.config['WIIM_PARTITIONS_AHEAD']))
+
+        cutoff, cutoffs = self.retention(now)
+        dropped = self.drop_expired(cutoff) if cutoff is not None else []
+        deleted = self.prune_tags(cutoffs)
+
+        if dropped or deleted:
+            invalidate([Record.__tablename__])
+
+        return {'created': created, 'dropped': dropped, 'deleted': deleted}
+
 
 # Initialize services
-site_service = BaseService(Site, SiteSchema)
-zone_service = BaseService(Zone, ZoneSchema)
-process_service = BaseService(Process, ProcessSchema)
-server_service = BaseService(Server, ServerSchema)
-tag_service = TagService(Tag, TagSchema)
-record_service = RecordService(Record, RecordSchema)
+site_service = BaseService(Site, SiteSchema, [selectinload(Site.zones)])
+zone_service = BaseService(Zone, ZoneSchema,
+                           [joinedload(Zone.site), selectinload(Zone.processes)])
+process_service = BaseService(Process, ProcessSchema,
+                              [joinedload(Process.zone), selectinload(Process.tags)])
+server_service = BaseService(Server, ServerSchema, [selectinload(Server.tags)])
+tag_service = TagService(Tag, TagSchema, [joinedload(Tag.server)])
+record_service = RecordService(Record, RecordSchema, [selectinload(Record.tag)])
+rollup_service = RollupService()
+aggregate_service = AggregateService()
 timeline_service = TimelineService()
+retention_service = RetentionService()
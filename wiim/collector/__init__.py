@@ -0,0 +1,46 @@
+"""
+wiim.collector
+
+Headless OPC-UA data collector feeding the record store
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+from .writer import RecordWriter
+
+# engines tried when not configured, asyncio first
+ENGINES = ('asyncio', 'thread')
+
+
+def create_collector(app, size=None, interval=None):
+    """ Create collector of WIIM_COLLECT_ENGINE, None tries all ENGINES
+
+    Args:
+        app (Flask): application with database
+
+    Kwargs:
+        size (int, optional): records per insert
+        interval (float, optional): maximum seconds between inserts
+
+    Returns:
+        An AsyncCollector, using asyncua, or a Collector, using opcua
+
+    Raises:
+        ImportError: If OPC-UA library of configured engine is not installed
+    """
+    names = [app.config['WIIM_COLLECT_ENGINE']] if app.config['WIIM_COLLECT_ENGINE'] \
+        else ENGINES
+
+    for name in names:
+        try:
+            if name == 'asyncio':
+                from .engine import AsyncCollector as collector
+            else:
+                from .collector import Collector as collector
+        except ImportError:
+            if name == names[-1]:
+                raise
+            continue
+
+        return collector(app, size, interval)
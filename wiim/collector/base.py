@@ -0,0 +1,66 @@
+"""
+wiim.collector.base
+
+Helpers shared by collector engines
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+from datetime import datetime
+from wiim.api.models import db, Server, Tag, QUALITY_NAMES
+from .filters import TagFilter
+
+
+def load_servers(app):
+    """ Get servers with endpoint and their tags with node id
+
+    Args:
+        app (Flask): application with database
+
+    Returns:
+        A dict of tags filters by node id, for each server id and endpoint pair
+    """
+    servers = {}
+
+    with app.app_context():
+        query = db.session.query(
+            Server.id, Server.endpoint, Tag.node_id,
+            Tag.id, Tag.deadband, Tag.deadband_type, Tag.heartbeat, Tag.compression
+        ).join(Tag, Tag.server_id == Server.id)\
+            .filter(Server.endpoint.isnot(None), Tag.node_id.isnot(None))
+
+        for server_id, endpoint, node_id, tag_id, deadband, deadband_type, heartbeat, \
+                compression in query:
+            servers.setdefault((server_id, endpoint), {})[node_id] = TagFilter(
+                tag_id, deadband, deadband_type == 'percent', heartbeat, compression)
+
+        db.session.remove()
+
+    return servers
+
+
+def to_record(tag_id, data_value):
+    """ Get record attributes from OPC-UA data value
+
+    Args:
+        tag_id (int): tag of record
+        data_value (ua.DataValue): notified value with status and timestamps
+
+    Returns:
+        A dict with record attributes, None if it has no value
+    """
+    value = data_value.Value.Value if data_value.Value is not None else None
+    if value is None:
+        return None
+
+    timestamp = data_value.SourceTimestamp or data_value.ServerTimestamp or datetime.utcnow()
+    # severity bits of status code, 11 (reserved) as bad
+    severity = min((data_value.StatusCode.value if data_value.StatusCode else 0) >> 30, 2)
+
+    return {
+        'tag_id': tag_id,
+        'time_opc': timestamp.isoformat(timespec='milliseconds'),
+        'value': value,
+        'quality': QUALITY_NAMES[severity],
+    }
@@ -0,0 +1,279 @@
+"""
+wiim.collector.collector
+
+Headless OPC-UA collector of tags data changes
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import logging
+import signal
+import threading
+from opcua import ua, Client
+from .base import load_servers, to_record
+from .filters import deadband_groups
+from .writer import RecordWriter
+
+logger = logging.getLogger(__name__)
+
+
+class ServerCollector():
+    """ Connection to one OPC-UA server with a subscription of all its tags
+
+    A thread keeps the connection, checking it every WIIM_COLLECT_CHECK_INTERVAL
+    seconds. When lost, it reconnects and subscribes again, waiting twice as
+    long after each failure up to WIIM_COLLECT_RECONNECT_MAX seconds.
+
+    Tags with deadband are monitored with data change filters, when server
+    supports them, and filtered here too, as servers may not implement them
+    or the percent type. Heartbeats are sent on each check.
+
+    Args:
+        app (Flask): application with collector settings
+        server_id (int): server id
+        endpoint (str): OPC-UA endpoint url
+        tags (dict): tags filters by node id
+        writer (RecordWriter): writer of records
+    """
+
+    def __init__(self, app, server_id, endpoint, tags, writer):
+        self.server_id = server_id
+        self.endpoint = endpoint
+        self.tags = tags
+        self.writer = writer
+        self.publish_interval = app.config['WIIM_COLLECT_PUBLISH_INTERVAL']
+        self.check_interval = app.config['WIIM_COLLECT_CHECK_INTERVAL']
+        self.reconnect_max = app.config['WIIM_COLLECT_RECONNECT_MAX']
+        self.client = None
+        self.nodes = {}  # tags filters by subscribed nodes ids
+        self.lock = threading.Lock()  # filters are used by subscription thread
+        self.lost = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """ Start connection thread """
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='server-{}'.format(self.server_id))
+        self.thread.start()
+
+    def stop(self):
+        """ Disconnect and stop connection thread """
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        """ Connection thread loop """
+        delay = 1
+
+        while not self.stopping.is_set():
+            try:
+                self.connect()
+                delay = 1
+
+                while not self.stopping.wait(self.check_interval):
+                    self.check()
+                    self.beat()
+            except Exception as error:
+                logger.warning('Server %s %s: %s, reconnecting in %d s',
+                               self.server_id, self.endpoint, error or type(error).__name__,
+                               delay)
+            finally:
+                self.disconnect()
+
+            if self.stopping.wait(delay):
+                break
+
+            delay = min(delay * 2, self.reconnect_max)
+
+    def connect(self):
+        """ Connect and subscribe data changes of tags nodes """
+        self.lost.clear()
+        self.client = Client(self.endpoint)
+        self.client.connect()
+
+        subscription = self.client.create_subscription(self.publish_interval, self)
+        self.nodes = {}
+
+        for deadband, node_ids in deadband_groups(self.tags).items():
+            nodes = [self.client.get_node(node_id) for node_id in node_ids]
+            # known before first notifications, with initial values
+            self.nodes.update((node.nodeid, self.tags[node_id])
+                              for node, node_id in zip(nodes, node_ids))
+
+            if deadband is not None:
+                nodes = self.subscribed(nodes, subscription.deadband_monitor(nodes, *deadband),
+                                        filtered=True)
+                if not nodes:
+                    continue
+
+            # without deadband, or not supported by server
+            self.subscribed(nodes, subscription.subscribe_data_change(nodes))
+
+        logger.info('Server %s %s connected, %d of %d tags subscribed',
+                    self.server_id, self.endpoint, len(self.nodes), len(self.tags))
+
+    def subscribed(self, nodes, handles, filtered=False):
+        """ Set filters of subscribed nodes
+
+        Args:
+            nodes (list of Node): nodes of monitored items
+            handles (list): monitored items handles, status code of failed ones
+
+        Kwargs:
+            filtered (bool): items were created with deadband filter, failures
+                are not errors as they are subscribed again without it
+
+        Returns:
+            A list with the failed nodes
+        """
+        failed = []
+
+        for node, handle in zip(nodes, handles):
+            if isinstance(handle, ua.StatusCode):
+                failed.append(node)
+                self.nodes.pop(node.nodeid, None)
+                if not filtered:
+                    logger.error('Server %s node %s not subscribed: %s',
+                                 self.server_id, node.nodeid.to_string(), handle.name)
+                continue
+
+            tag_filter = self.tags[node.nodeid.to_string()]
+            if tag_filter.percent and tag_filter.deadband:
+                tag_filter.span = self.span(node)
+
+            self.nodes[node.nodeid] = tag_filter
+
+        return failed
+
+    def span(self, node):
+        """ Get range of node values from EURange property, None if unknown """
+        try:
+            eu_range = node.get_child('0:EURange').get_value()
+            return eu_range.High - eu_range.Low
+        except Exception:
+            return None
+
+    def disconnect(self):
+        """ Close connection, ignoring errors of lost ones """
+        if self.client is None:
+            return
+
+        try:
+            self.client.disconnect()
+        except Exception:
+            pass
+
+        self.client = None
+
+    def check(self):
+        """ Read server state
+
+        Raises:
+            Exception: If connection or subscription was lost
+        """
+        if self.lost.is_set():
+            raise Exception('subscription lost')
+
+        self.client.get_node(ua.ObjectIds.Server_ServerStatus_State).get_value()
+
+    def beat(self):
+        """ Queue last records of tags without records for heartbeat seconds """
+        with self.lock:
+            records = [record for tag_filter in self.nodes.values()
+                       for record in tag_filter.beat()]
+
+        for record in records:
+            self.writer.put(record)
+
+    def datachange_notification(self, node, val, data):
+        """ Subscription handler of data changes, queue record of tag """
+        tag_filter = self.nodes.get(node.nodeid)
+        if tag_filter is None:
+            return
+
+        record = to_record(tag_filter.tag_id, data.monitored_item.Value)
+        if record is None:
+            return
+
+        with self.lock:
+            records = tag_filter.filter(record)
+
+        for record in records:
+            self.writer.put(record)
+
+    def status_change_notification(self, status):
+        """ Subscription handler of status changes, timeout means session lost """
+        self.lost.set()
+
+    def event_notification(self, event):
+        pass
+
+
+class Collector():
+    """ Collect data changes of tags with node id from servers with endpoint
+
+    Args:
+        app (Flask): application with database
+
+    Kwargs:
+        size (int, optional): records per insert
+        interval (float, optional): maximum seconds between inserts
+    """
+
+    def __init__(self, app, size=None, interval=None):
+        self.app = app
+        self.writer = RecordWriter(app, size, interval)
+        self.servers = []
+
+    def load(self):
+        """ Create a server collector for each server with tags to collect """
+        # node ids in the same format of subscribed nodes
+        self.servers = [
+            ServerCollector(self.app, server_id, endpoint,
+                            {ua.NodeId.from_string(k).to_string(): v for k, v in nodes.items()},
+                            self.writer)
+            for (server_id, endpoint), nodes in load_servers(self.app).items()
+        ]
+
+    def start(self):
+        """ Start writer and connections """
+        self.load()
+        self.writer.start()
+
+        for server in self.servers:
+            server.start()
+
+        logger.info('Collecting %d tags of %d servers',
+                    sum(len(s.tags) for s in self.servers), len(self.servers))
+
+    def stop(self):
+        """ Stop connections, then write queued records """
+        for server in self.servers:
+            server.stop()
+
+            # held records of compression
+            for tag_filter in server.tags.values():
+                for record in tag_filter.flush():
+                    self.writer.put(record)
+
+        self.writer.stop()
+
+        logger.info('Collector stopped, %d records written, %d dropped',
+                    self.writer.written, self.writer.dropped)
+
+    def run(self):
+        """ Collect until interrupted or terminated """
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+        self.start()
+        try:
+            while not stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
@@ -0,0 +1,350 @@
+"""
+wiim.collector.engine
+
+Asyncio OPC-UA acquisition engine, all servers in one event loop
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import asyncio
+import logging
+import signal
+from asyncua import ua, Client
+from .base import load_servers, to_record
+from .filters import deadband_groups
+from .writer import RecordWriter
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncServerCollector():
+    """ Connection task of one OPC-UA server with a subscription of all its tags
+
+    The connection is checked every WIIM_COLLECT_CHECK_INTERVAL seconds. When
+    the session is lost, it reconnects and creates the subscription again,
+    waiting twice as long after each failure up to WIIM_COLLECT_RECONNECT_MAX
+    seconds.
+
+    Tags with deadband are monitored with data change filters, when server
+    supports them, and filtered here too, as servers may not implement them
+    or the percent type. Heartbeats are sent on each check.
+
+    Args:
+        app (Flask): application with collector settings
+        server_id (int): server id
+        endpoint (str): OPC-UA endpoint url
+        tags (dict): tags filters by node id
+        engine (AsyncCollector): engine receiving the records
+    """
+
+    def __init__(self, app, server_id, endpoint, tags, engine):
+        self.server_id = server_id
+        self.endpoint = endpoint
+        self.tags = tags
+        self.engine = engine
+        self.publish_interval = app.config['WIIM_COLLECT_PUBLISH_INTERVAL']
+        self.check_interval = app.config['WIIM_COLLECT_CHECK_INTERVAL']
+        self.reconnect_max = app.config['WIIM_COLLECT_RECONNECT_MAX']
+        self.client = None
+        self.nodes = {}  # tags filters by subscribed nodes ids
+        self.lost = None
+
+    async def run(self):
+        """ Connection task loop, until cancelled """
+        delay = 1
+
+        while True:
+            try:
+                await self.connect()
+                delay = 1
+
+                while True:
+                    await asyncio.sleep(self.check_interval)
+                    await self.check()
+                    self.beat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.warning('Server %s %s: %s, reconnecting in %d s',
+                               self.server_id, self.endpoint, error or type(error).__name__,
+                               delay)
+            finally:
+                await self.disconnect()
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.reconnect_max)
+
+    async def connect(self):
+        """ Connect and subscribe data changes of tags nodes """
+        self.lost = False
+        self.client = Client(self.endpoint)
+        await self.client.connect()
+
+        subscription = await self.client.create_subscription(self.publish_interval, self)
+        self.nodes = {}
+
+        for deadband, node_ids in deadband_groups(self.tags).items():
+            nodes = [self.client.get_node(node_id) for node_id in node_ids]
+            # known before first notifications, with initial values
+            self.nodes.update((node.nodeid, self.tags[node_id])
+                              for node, node_id in zip(nodes, node_ids))
+
+            if deadband is not None:
+                handles = await subscription.deadband_monitor(nodes, *deadband)
+                nodes = await self.subscribed(nodes, handles, filtered=True)
+                if not nodes:
+                    continue
+
+            # without deadband, or not supported by server
+            handles = await subscription.subscribe_data_change(nodes)
+            await self.subscribed(nodes, handles)
+
+        logger.info('Server %s %s connected, %d of %d tags subscribed',
+                    self.server_id, self.endpoint, len(self.nodes), len(self.tags))
+
+    async def subscribed(self, nodes, handles, filtered=False):
+        """ Set filters of subscribed nodes
+
+        Args:
+            nodes (list of Node): nodes of monitored items
+            handles (list): monitored items handles, status code of failed ones
+
+        Kwargs:
+            filtered (bool): items were created with deadband filter, failures
+                are not errors as they are subscribed again without it
+
+        Returns:
+            A list with the failed nodes
+        """
+        failed = []
+
+        for node, handle in zip(nodes, handles):
+            if isinstance(handle, ua.StatusCode):
+                failed.append(node)
+                self.nodes.pop(node.nodeid, None)
+                if not filtered:
+                    logger.error('Server %s node %s not subscribed: %s',
+                                 self.server_id, node.nodeid.to_string(), handle.name)
+                continue
+
+            tag_filter = self.tags[node.nodeid.to_string()]
+            if tag_filter.percent and tag_filter.deadband:
+                tag_filter.span = await self.span(node)
+
+            self.nodes[node.nodeid] = tag_filter
+
+        return failed
+
+    async def span(self, node):
+        """ Get range of node values from EURange property, None if unknown """
+        try:
+            eu_range = await (await node.get_child('0:EURange')).read_value()
+            return eu_range.High - eu_range.Low
+        except Exception:
+            return None
+
+    async def disconnect(self):
+        """ Close connection, ignoring errors of lost ones """
+        if self.client is None:
+            return
+
+        try:
+            await self.client.disconnect()
+        except Exception:
+            pass
+
+        self.client = None
+
+    async def check(self):
+        """ Read server state
+
+        Raises:
+            Exception: If connection or subscription was lost
+        """
+        if self.lost:
+            raise Exception('subscription lost')
+
+        await self.client.get_node(ua.ObjectIds.Server_ServerStatus_State).read_value()
+
+    def beat(self):
+        """ Queue last records of tags without records for heartbeat seconds """
+        for tag_filter in self.nodes.values():
+            for record in tag_filter.beat():
+                self.engine.put(record)
+
+    def datachange_notification(self, node, val, data):
+        """ Subscription handler of data changes, queue record of tag """
+        tag_filter = self.nodes.get(node.nodeid)
+        if tag_filter is None:
+            return
+
+        record = to_record(tag_filter.tag_id, data.monitored_item.Value)
+        if record is None:
+            return
+
+        for record in tag_filter.filter(record):
+            self.engine.put(record)
+
+    def status_change_notification(self, status):
+        """ Subscription handler of status changes, timeout means session lost """
+        self.lost = True
+
+    def event_notification(self, event):
+        pass
+
+
+class AsyncCollector():
+    """ Collect data changes of tags from all servers in one event loop
+
+    Notifications go to a queue bounded by WIIM_COLLECT_BUFFER, dropping the
+    oldest records when full. A writer task takes batches of flush size
+    records, or what arrived in flush interval seconds, and inserts them in
+    a thread, so the loop is never blocked by database. Failed batches are
+    retried while the queue fills. With WIIM_COLLECT_SPOOL, records are
+    appended to the on-disk queue and written by the writer thread.
+
+    Args:
+        app (Flask): application with database
+
+    Kwargs:
+        size (int, optional): records per insert
+        interval (float, optional): maximum seconds between inserts
+    """
+
+    def __init__(self, app, size=None, interval=None):
+        self.app = app
+        self.writer = RecordWriter(app, size, interval)
+        self.reconnect_max = app.config['WIIM_COLLECT_RECONNECT_MAX']
+        self.servers = []
+        self.queue = None
+        self.closing = None
+
+    def load(self):
+        """ Create a server collector for each server with tags to collect """
+        # node ids in the same format of subscribed nodes
+        self.servers = [
+            AsyncServerCollector(self.app, server_id, endpoint,
+                                 {ua.NodeId.from_string(k).to_string(): v
+                                  for k, v in nodes.items()},
+                                 self)
+            for (server_id, endpoint), nodes in load_servers(self.app).items()
+        ]
+
+    def put(self, record):
+        """ Queue record to insert, dropping the oldest one when full """
+        if self.writer.spool is not None:
+            self.writer.put(record)
+            return
+
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.writer.dropped += 1
+
+        self.queue.put_nowait(record)
+
+    async def batch(self):
+        """ Wait records for a batch
+
+        Returns:
+            A list with up to flush size records, empty if none arrived
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.writer.interval
+        batch = []
+
+        while len(batch) < self.writer.size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if self.closing.is_set() or timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def write(self):
+        """ Writer task loop, until closing and queue is empty """
+        loop = asyncio.get_event_loop()
+
+        while not (self.closing.is_set() and self.queue.empty()):
+            batch = await self.batch()
+            delay = 1
+
+            while batch:
+                # rest of batch not written while database is unavailable
+                batch = batch[await loop.run_in_executor(None, self.writer.write, batch):]
+                if not batch:
+                    break
+
+                if self.closing.is_set():
+                    logger.error('%d collected records not written',
+                                 len(batch) + self.queue.qsize())
+                    return
+
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max)
+
+    async def main(self, stopping):
+        """ Collect until stopping is set
+
+        Args:
+            stopping (asyncio.Event): stop collecting
+        """
+        self.queue = asyncio.Queue(self.app.config['WIIM_COLLECT_BUFFER'])
+        self.closing = asyncio.Event()
+
+        if self.writer.spool is not None:
+            self.writer.start()
+            writer = None
+        else:
+            writer = asyncio.ensure_future(self.write())
+
+        tasks = [asyncio.ensure_future(server.run()) for server in self.servers]
+
+        logger.info('Collecting %d tags of %d servers',
+                    sum(len(s.tags) for s in self.servers), len(self.servers))
+
+        await stopping.wait()
+
+        # stop connections, then write queued records
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # held records of compression
+        for server in self.servers:
+            for tag_filter in server.tags.values():
+                for record in tag_filter.flush():
+                    self.put(record)
+
+        self.closing.set()
+        if writer is not None:
+            await writer
+        else:
+            await asyncio.get_event_loop().run_in_executor(None, self.writer.stop)
+
+        logger.info('Collector stopped, %d records written, %d dropped',
+                    self.writer.written, self.writer.dropped)
+
+    def run(self):
+        """ Collect until interrupted or terminated """
+        self.load()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        stopping = asyncio.Event()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopping.set)
+
+        try:
+            loop.run_until_complete(self.main(stopping))
+        finally:
+            loop.close()
@@ -0,0 +1,270 @@
+"""
+wiim.collector.filters
+
+Exception based filtering of tags values, deadband and heartbeat
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import math
+from datetime import datetime
+from time import monotonic
+from wiim.api.models import DEADBAND_TYPES
+
+# format of records time_opc, as written by collector
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+EPOCH = datetime(1970, 1, 1)
+
+
+def is_number(value):
+    """ Check if value is a number, booleans are not """
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def seconds(record):
+    """ Get time_opc of record as seconds since epoch """
+    return (datetime.strptime(record['time_opc'], TIME_FORMAT) - EPOCH).total_seconds()
+
+
+def now_record(record):
+    """ Copy of record at current time """
+    return dict(record, time_opc=datetime.utcnow().isoformat(timespec='milliseconds'))
+
+
+class SwingingDoor():
+    """ Swinging door compression of a tag values
+
+    Keeps only the records needed to rebuild the signal by linear
+    interpolation within deviation. The last received record is held and
+    stored only when the line from the last stored record to a later one
+    does not pass within deviation of all records between them.
+
+    Args:
+        deviation (float): maximum error of interpolated values
+
+    Kwargs:
+        max_gap (int, optional): maximum seconds between stored records
+
+    Attributes:
+        held (dict): received record not stored yet
+    """
+
+    def __init__(self, deviation, max_gap=None):
+        self.deviation = deviation
+        self.max_gap = max_gap
+        self.held = None
+        self.held_time = None
+        self.archived = None  # last stored record
+        self.archived_time = None
+        self.upper = math.inf  # slopes of door sides
+        self.lower = -math.inf
+
+    def restart(self, record, time):
+        """ Start door from stored record """
+        self.archived, self.archived_time = record, time
+        self.held = self.held_time = None
+        self.upper, self.lower = math.inf, -math.inf
+
+    def slopes(self, record, time):
+        """ Get door sides slopes narrowed by record """
+        value, base = record['value'], self.archived['value']
+        elapsed = time - self.archived_time
+
+        return (min(self.upper, (value + self.deviation - base) / elapsed),
+                max(self.lower, (value - self.deviation - base) / elapsed))
+
+    def add(self, record):
+        """ Compress record
+
+        Args:
+            record (dict): record attributes with time_opc, value and quality
+
+        Returns:
+            A list with records to store, oldest first
+        """
+        time = seconds(record)
+        archived = self.archived
+
+        # not compressible, store with held one
+        if archived is None or record['quality'] != archived['quality'] or \
+                not is_number(record['value']) or not is_number(archived['value']) or \
+                time <= self.archived_time:
+            stored = self.flush() + [record]
+            self.restart(record, time)
+            return stored
+
+        # line from stored record to this one passes within deviation of held ones
+        slope = (record['value'] - archived['value']) / (time - self.archived_time)
+        gap = self.max_gap and time - self.archived_time > self.max_gap
+
+        if self.lower <= slope <= self.upper and not gap:
+            self.upper, self.lower = self.slopes(record, time)
+            self.held, self.held_time = record, time
+            return []
+
+        if self.held is None:
+            self.restart(record, time)
+            return [record]
+
+        # door opened, held record is a turning point
+        held = self.held
+        if time <= self.held_time:
+            # no line from held record, both stored as received
+            self.restart(record, time)
+            return [held, record]
+
+        self.restart(held, self.held_time)
+        self.upper, self.lower = self.slopes(record, time)
+        self.held, self.held_time = record, time
+
+        return [held]
+
+    def flush(self):
+        """ Store held record
+
+        Returns:
+            A list with held record, empty if none
+        """
+        if self.held is None:
+            return []
+
+        held = self.held
+        self.restart(held, self.held_time)
+
+        return [held]
+
+
+class TagFilter():
+    """ Decide which values of a tag are stored
+
+    A value passes when it differs from the last passed one more than
+    deadband, when quality changes, or when heartbeat seconds passed since
+    the last stored. Percent deadband is relative to the range of value,
+    or to the last passed value when range is unknown. Values that are not
+    numbers pass when they change. With compression, passed values, and
+    the last one that did not pass before each, are compressed by swinging
+    door, with heartbeat as maximum gap.
+
+    Args:
+        tag_id (int): tag id
+
+    Kwargs:
+        deadband (float, optional): minimum change of value, None passes all
+        percent (bool): deadband is percent of range
+        heartbeat (int, optional): maximum seconds without stored values
+        compression (float, optional): swinging door deviation, None to not compress
+
+    Attributes:
+        span (float): range of value, high minus low, for percent deadband
+    """
+
+    def __init__(self, tag_id, deadband=None, percent=False, heartbeat=None, compression=None):
+        self.tag_id = tag_id
+        self.deadband = deadband or None
+        self.percent = percent
+        self.heartbeat = heartbeat
+        self.door = SwingingDoor(compression, heartbeat) if compression else None
+        self.span = None
+        self.last = None  # last passed record
+        self.skipped = None  # last record that did not pass
+        self.stored = None  # last stored record
+        self.last_time = None  # monotonic time of last stored
+
+    def changed(self, record):
+        """ Check if record value or quality changed from last passed """
+        last = self.last
+        if last is None or record['quality'] != last['quality']:
+            return True
+
+        value, last_value = record['value'], last['value']
+        if not is_number(value) or not is_number(last_value) or self.deadband is None:
+            return value != last_value
+
+        deadband = self.deadband
+        if self.percent:
+            deadband *= (self.span if self.span else abs(last_value)) / 100
+
+        return abs(value - last_value) > deadband
+
+    def filter(self, record):
+        """ Get records to store when record is received
+
+        Args:
+            record (dict): record attributes with time_opc, value and quality
+
+        Returns:
+            A list with records to store, oldest first
+        """
+        now = monotonic()
+        due = self.heartbeat and self.last_time is not None and \
+            now - self.last_time >= self.heartbeat
+
+        if not self.changed(record) and not due:
+            self.skipped = record
+            return []
+
+        self.last = record
+        if self.door is None:
+            return self.store([record], now)
+
+        # last skipped one first, so compressed signal keeps flat segments
+        records = [self.skipped, record] if self.skipped is not None else [record]
+        self.skipped = None
+
+        return self.store([r for received in records for r in self.door.add(received)], now)
+
+    def beat(self):
+        """ Get records to store when heartbeat seconds passed without records
+
+        Held record of compression is stored, else last stored is repeated.
+
+        Returns:
+            A list with records to store, empty if not due
+        """
+        now = monotonic()
+
+        if not self.heartbeat or self.stored is None or now - self.last_time < self.heartbeat:
+            return []
+
+        if self.door is not None and self.door.held is not None:
+            return self.store(self.door.flush(), now)
+
+        record = now_record(self.stored)
+        if self.door is not None:
+            self.door.restart(record, seconds(record))
+
+        return self.store([record], now)
+
+    def flush(self):
+        """ Get held record of compression to store, when collector stops """
+        return self.store(self.door.flush(), monotonic()) if self.door else []
+
+    def store(self, records, now):
+        """ Keep last of records to store """
+        if records:
+            self.stored = records[-1]
+            self.last_time = now
+
+        return records
+
+
+def deadband_groups(filters):
+    """ Group nodes by deadband, to create monitored items with same data change filter
+
+    Args:
+        filters (dict): tag filters by node id
+
+    Returns:
+        A dict of nodes ids lists by (deadband, OPC-UA deadband type), None for
+        nodes without deadband
+    """
+    groups = {}
+
+    for node_id, tag_filter in filters.items():
+        key = (tag_filter.deadband,
+               DEADBAND_TYPES['percent' if tag_filter.percent else 'absolute']) \
+            if tag_filter.deadband else None
+        groups.setdefault(key, []).append(node_id)
+
+    return groups
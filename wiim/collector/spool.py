@@ -0,0 +1,314 @@
+"""
+wiim.collector.spool
+
+Durable on-disk queue of collected records, store and forward
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import os
+import json
+import mmap
+import struct
+import threading
+import zlib
+
+# entry header, payload length and crc32, zero length is end of segment
+HEADER = struct.Struct('<II')
+CURSOR = 'cursor'
+REJECTED = 'rejected'
+# next segment created ahead, numbered only when used
+SPARE = 'spare.tmp'
+
+
+class Segment():
+    """ Append-only segment file mapped in memory
+
+    Args:
+        path (str): file path, created with size if missing
+        size (int): file size in bytes
+
+    Attributes:
+        end (int): offset after last valid entry
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+
+        if not os.path.exists(path):
+            with open(path, 'wb') as file:
+                file.truncate(size)
+
+        with open(path, 'r+b') as file:
+            self.size = os.fstat(file.fileno()).st_size
+            self.map = mmap.mmap(file.fileno(), self.size)
+
+        self.end = 0
+        for offset, payload in self.entries(0):
+            self.end = offset
+
+    def entries(self, offset):
+        """ Iterate entries from offset
+
+        Args:
+            offset (int): offset of first entry
+
+        Yields:
+            Tuples of offset after entry and its payload, until end or a torn write
+        """
+        while offset + HEADER.size <= self.size:
+            length, crc = HEADER.unpack_from(self.map, offset)
+            start = offset + HEADER.size
+            if not length or start + length > self.size:
+                return
+
+            payload = self.map[start:start + length]
+            if zlib.crc32(payload) != crc:
+                return
+
+            offset = start + length
+            yield offset, payload
+
+    def append(self, payload):
+        """ Write entry after last one
+
+        Returns:
+            False if there is no room left for it
+        """
+        start = self.end + HEADER.size
+        # keep room for a zero header ending the segment
+        if start + len(payload) + HEADER.size > self.size:
+            return False
+
+        # payload first, header makes the entry valid
+        self.map[start:start + len(payload)] = payload
+        HEADER.pack_into(self.map, self.end, len(payload), zlib.crc32(payload))
+        self.end = start + len(payload)
+
+        return True
+
+    def sync(self):
+        """ Flush written pages to disk """
+        self.map.flush()
+
+    def rename(self, path):
+        """ Move file to path, keeping it mapped """
+        os.replace(self.path, path)
+        self.path = path
+
+    def close(self):
+        self.map.close()
+
+
+class Spool():
+    """ Queue of records in append-only memory-mapped segment files
+
+    Records are appended to the last segment and read in order from the
+    cursor, the position after the records already written to database.
+    Writes are flushed to disk by a thread every sync interval seconds,
+    which also creates the next segment ahead, so appends cost a memory
+    copy. The cursor is saved without sync, as the records replayed after
+    a crash are deduplicated by the writer. Records rejected by the
+    database are kept in the rejected file, one JSON per line.
+
+    Args:
+        path (str): directory of segments files
+
+    Kwargs:
+        segment_size (int): bytes per segment file
+        sync_interval (float): maximum seconds between flushes to disk
+
+    Attributes:
+        pending (int): records not acknowledged
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, sync_interval=1.0):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        # held while flushing segments, so they are not closed meanwhile
+        self.sync_lock = threading.Lock()
+        # numbers of segments with appends not flushed
+        self.unsynced = set()
+        # next segment, created ahead by sync thread
+        self.spare = None
+
+        os.makedirs(path, exist_ok=True)
+
+        # left by a stop before it was used
+        if os.path.exists(os.path.join(path, SPARE)):
+            os.remove(os.path.join(path, SPARE))
+
+        numbers = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.seg'))
+        self.cursor = self.load_cursor(numbers)
+
+        # acknowledged segments
+        for number in numbers:
+            if number < self.cursor[0]:
+                os.remove(self.segment_path(number))
+
+        numbers = [number for number in numbers if number >= self.cursor[0]] or [self.cursor[0]]
+        self.segments = {number: Segment(self.segment_path(number), segment_size)
+                         for number in numbers}
+        self.last = numbers[-1]
+
+        self.pending = sum(1 for _ in self.entries(self.cursor))
+
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='spool-sync', daemon=True)
+        self.thread.start()
+
+    def segment_path(self, number):
+        return os.path.join(self.path, '{:016d}.seg'.format(number))
+
+    def load_cursor(self, numbers):
+        """ Get saved cursor, or start of first segment """
+        try:
+            with open(os.path.join(self.path, CURSOR)) as file:
+                number, offset = file.read().split()
+                return int(number), int(offset)
+        except (OSError, ValueError):
+            return (numbers[0] if numbers else 0), 0
+
+    def entries(self, position):
+        """ Iterate entries from position through all segments
+
+        Yields:
+            Tuples of position after entry and its payload
+        """
+        first, start = position
+
+        for number in range(first, self.last + 1):
+            segment = self.segments.get(number)
+            if segment is None:
+                continue
+
+            for offset, payload in segment.entries(start if number == first else 0):
+                yield (number, offset), payload
+
+    def append(self, record):
+        """ Append record, without waiting for disk
+
+        Args:
+            record (dict): record attributes
+
+        Raises:
+            ValueError: If record is bigger than a segment
+        """
+        payload = json.dumps(record, default=str).encode()
+
+        with self.lock:
+            if not self.segments[self.last].append(payload):
+                # start next segment, created now only if sync thread is late,
+                # numbered segments are only created here
+                if self.spare is not None:
+                    segment, self.spare = self.spare, None
+                    segment.rename(self.segment_path(self.last + 1))
+                else:
+                    segment = Segment(self.segment_path(self.last + 1), self.segment_size)
+
+                self.last += 1
+                self.segments[self.last] = segment
+
+                if not segment.append(payload):
+                    raise ValueError('Record bigger than spool segment')
+
+            self.pending += 1
+            self.unsynced.add(self.last)
+
+    def run(self):
+        """ Sync thread loop """
+        while not self.closing.wait(self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """ Flush appended records to disk and create next segment ahead """
+        with self.sync_lock:
+            with self.lock:
+                segments = [self.segments[number] for number in self.unsynced
+                            if number in self.segments]
+                self.unsynced = set()
+                missing = self.spare is None
+
+            for segment in segments:
+                segment.sync()
+
+        if not missing or self.closing.is_set():
+            return
+
+        # under a temporary name, it gets its number when append uses it
+        spare = Segment(os.path.join(self.path, SPARE), self.segment_size)
+        with self.lock:
+            self.spare = spare
+
+    def read(self, count):
+        """ Get records from cursor, without removing them
+
+        Args:
+            count (int): maximum records
+
+        Returns:
+            A tuple with list of records and list of positions to acknowledge
+            them, the position after each one
+        """
+        records = []
+        positions = []
+
+        with self.lock:
+            for position, payload in self.entries(self.cursor):
+                records.append(json.loads(payload.decode()))
+                positions.append(position)
+                if len(records) >= count:
+                    break
+
+        return records, positions
+
+    def ack(self, position, count):
+        """ Remove records before position, written to database
+
+        Args:
+            position (tuple): position returned by read
+            count (int): records read
+        """
+        with self.sync_lock, self.lock:
+            self.cursor = position
+            self.pending -= count
+
+            # save cursor atomically, without sync
+            path = os.path.join(self.path, CURSOR)
+            with open(path + '.tmp', 'w') as file:
+                file.write('{} {}'.format(*position))
+            os.replace(path + '.tmp', path)
+
+            # remove segments fully read
+            for number in [n for n in self.segments if n < position[0]]:
+                self.segments.pop(number).close()
+                os.remove(self.segment_path(number))
+
+    def reject(self, records):
+        """ Keep records rejected by database in the rejected file
+
+        Args:
+            records (list of dict): records attributes
+        """
+        with open(os.path.join(self.path, REJECTED), 'a') as file:
+            for record in records:
+                file.write(json.dumps(record, default=str) + '\n')
+
+    def close(self):
+        """ Stop sync thread, flush and close segments """
+        self.closing.set()
+        self.thread.join()
+        self.sync()
+
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+
+            # empty, created ahead
+            if self.spare is not None:
+                self.spare.close()
+                os.remove(self.spare.path)
+                self.spare = None
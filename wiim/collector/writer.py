@@ -0,0 +1,259 @@
+"""
+wiim.collector.writer
+
+Batching writer of collected records
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import logging
+import threading
+from collections import deque
+from sqlalchemy import exc
+from wiim.api.services import db, record_service
+from .spool import Spool
+
+logger = logging.getLogger(__name__)
+
+
+def transient(error):
+    """ Check if error is of database connection or server, not of the records
+
+    Args:
+        error (Exception): error of insert
+
+    Returns:
+        True if the same insert may succeed later
+    """
+    if isinstance(error, exc.DBAPIError) and error.connection_invalidated:
+        return True
+
+    # lost connections, deadlocks, lock timeouts, pool timeouts and socket errors
+    return isinstance(error, (exc.OperationalError, exc.InterfaceError,
+                              exc.DisconnectionError, exc.TimeoutError, OSError))
+
+
+class RecordWriter():
+    """ Queue records and insert them in bulk from a thread
+
+    A batch is inserted when flush size records are queued or every flush
+    interval seconds. While database is unavailable, batches are kept and
+    tried again, waiting twice as long after each failure up to
+    WIIM_COLLECT_RECONNECT_MAX seconds, with up to WIIM_COLLECT_BUFFER
+    records, dropping the oldest. Records failing a batch for other reasons
+    are rejected alone.
+
+    With WIIM_COLLECT_SPOOL, records are queued on disk instead, kept
+    through outages and restarts without limit of memory. The backlog is
+    replayed in batches of WIIM_BATCH_LIMIT, skipping records already stored.
+    Rejected records are kept in the rejected file of spool.
+
+    Args:
+        app (Flask): application with database
+
+    Kwargs:
+        size (int, optional): records per insert, WIIM_COLLECT_FLUSH_SIZE if empty
+        interval (float, optional): maximum seconds between inserts,
+            WIIM_COLLECT_FLUSH_INTERVAL if empty
+
+    Attributes:
+        written (int): records inserted
+        dropped (int): records lost by buffer overflow or rejected by validation
+    """
+
+    def __init__(self, app, size=None, interval=None):
+        self.app = app
+        self.size = min(size or app.config['WIIM_COLLECT_FLUSH_SIZE'],
+                        app.config['WIIM_BATCH_LIMIT'])
+        self.interval = interval or app.config['WIIM_COLLECT_FLUSH_INTERVAL']
+        self.limit = app.config['WIIM_COLLECT_BUFFER']
+        self.reconnect_max = app.config['WIIM_COLLECT_RECONNECT_MAX']
+        self.spool = Spool(
+            app.config['WIIM_COLLECT_SPOOL'],
+            app.config['WIIM_COLLECT_SEGMENT_SIZE'],
+            app.config['WIIM_COLLECT_SYNC_INTERVAL']
+        ) if app.config['WIIM_COLLECT_SPOOL'] else None
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.full = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.written = 0
+        self.dropped = 0
+
+    def put(self, record):
+        """ Queue record to insert
+
+        Args:
+            record (dict): record attributes with tag_id, time_opc, value and quality
+        """
+        if self.spool is not None:
+            self.spool.append(record)
+            if self.spool.pending >= self.size and not self.full.is_set():
+                self.full.set()
+            return
+
+        with self.lock:
+            if len(self.queue) >= self.limit:
+                self.queue.popleft()
+                self.dropped += 1
+
+            self.queue.append(record)
+
+            if len(self.queue) >= self.size:
+                self.full.set()
+
+    def start(self):
+        """ Start writer thread """
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='record-writer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Insert queued records and stop writer thread """
+        self.stopping.set()
+        self.full.set()
+        self.thread.join()
+
+        if self.spool is not None:
+            if self.spool.pending:
+                logger.warning('%d collected records kept in spool', self.spool.pending)
+            self.spool.close()
+        elif self.queue:
+            logger.error('%d collected records not written', len(self.queue))
+
+    def run(self):
+        """ Writer thread loop """
+        delay = 0
+
+        while True:
+            self.full.wait(self.interval)
+            self.full.clear()
+            stopping = self.stopping.is_set()
+
+            # insert all complete batches, then the remaining records
+            count = self.flush()
+            while count is not None and count >= self.size:
+                count = self.flush()
+
+            if stopping:
+                break
+
+            if count is None:
+                # database unavailable, full queue doesn't retry before delay
+                delay = min(delay * 2 or 1, self.reconnect_max)
+                self.stopping.wait(delay)
+            else:
+                delay = 0
+
+    def flush(self):
+        """ Insert one batch of queued records
+
+        Returns:
+            Count of records taken from queue, None if insert failed
+        """
+        if self.spool is not None:
+            return self.flush_spool()
+
+        with self.lock:
+            batch = [self.queue.popleft() for _ in range(min(self.size, len(self.queue)))]
+
+        if not batch:
+            return 0
+
+        written = self.write(batch)
+        if written < len(batch):
+            # rest back to queue front, keeping order
+            with self.lock:
+                self.queue.extendleft(reversed(batch[written:]))
+                while len(self.queue) > self.limit:
+                    self.queue.popleft()
+                    self.dropped += 1
+
+            return None
+
+        return len(batch)
+
+    def flush_spool(self):
+        """ Insert one batch of spool records, removing them when written
+
+        Returns:
+            Count of records written or rejected, None if insert failed
+        """
+        # replay backlog in batches as big as allowed
+        size = self.size if self.spool.pending <= self.size else \
+            self.app.config['WIIM_BATCH_LIMIT']
+        batch, positions = self.spool.read(size)
+        if not batch:
+            return 0
+
+        # the written ones are removed, the rest are read again
+        written = self.write(batch, dedupe=True)
+        if written:
+            self.spool.ack(positions[written - 1], written)
+
+        return written if written == len(batch) else None
+
+    def write(self, batch, dedupe=False):
+        """ Insert records, logging the rejected ones
+
+        A batch failing for other reasons than the database is split in
+        halves, until the records failing it are rejected alone.
+
+        Args:
+            batch (list of dict): records attributes
+
+        Kwargs:
+            dedupe (bool): skip records already stored
+
+        Returns:
+            Count of records, from batch start, inserted or rejected, less
+            than batch size if database failed
+        """
+        with self.app.app_context():
+            try:
+                result = record_service.create_many(batch, dedupe=dedupe)
+            except Exception as error:
+                db.session.rollback()
+
+                if transient(error):
+                    logger.exception('Insert of %d records failed, retrying later', len(batch))
+                    return 0
+
+                if len(batch) == 1:
+                    logger.error('Record of tag %s rejected: %s', batch[0].get('tag_id'), error)
+                    self.reject(batch)
+                    return 1
+
+                result = None
+            finally:
+                db.session.remove()
+
+        if result is None:
+            half = len(batch) // 2
+            written = self.write(batch[:half], dedupe)
+            if written < half:
+                return written
+
+            return half + self.write(batch[half:], dedupe)
+
+        for error in result['errors']:
+            logger.warning('Record of tag %s rejected: %s',
+                           batch[error['index']].get('tag_id'), error['messages'])
+
+        self.written += result['created']
+        self.reject([batch[error['index']] for error in result['errors']])
+
+        return len(batch)
+
+    def reject(self, records):
+        """ Drop records rejected by database, keeping them in spool if any
+
+        Args:
+            records (list of dict): records attributes
+        """
+        self.dropped += len(records)
+
+        if self.spool is not None and records:
+            self.spool.reject(records)
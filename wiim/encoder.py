@@ -0,0 +1,168 @@
+"""
+wiim.encoder
+
+Pluggable JSON encoder for responses
+
+:copyright: © 2018 by José Almeida
+:license: AGPLv3/Commercial, see LICENSE file for more details
+"""
+
+import re
+import json
+from datetime import date, datetime
+from flask import current_app
+from marshmallow.utils import isoformat
+
+# libraries tried by auto, fastest first
+ENCODERS = ('orjson', 'ujson', 'json')
+
+# characters out of ASCII, only found inside strings of JSON text
+NON_ASCII = re.compile('[^\x00-\x7f]')
+
+
+def default(obj):
+    """ Convert types unknown by encoders, naive datetimes as UTC like schemas """
+    if isinstance(obj, datetime):
+        return isoformat(obj)
+
+    if isinstance(obj, date):
+        return obj.isoformat()
+
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def _escape(match):
+    code = ord(match.group())
+
+    # out of basic plane as UTF-16 surrogate pair
+    if code > 0xFFFF:
+        code -= 0x10000
+        return '\\u{:04x}\\u{:04x}'.format(0xD800 | code >> 10, 0xDC00 | code & 0x3FF)
+
+    return '\\u{:04x}'.format(code)
+
+
+def ascii_escape(text):
+    """ Escape non ASCII characters of JSON text, like json with ensure_ascii """
+    try:
+        text.encode('ascii')
+        return text
+    except UnicodeEncodeError:
+        return NON_ASCII.sub(_escape, text)
+
+
+class JSONProvider():
+    """ Encode responses with the configured JSON library
+
+    All libraries output the same JSON text, with keys converted to strings
+    and naive datetimes as UTC, except for NaN and infinite floats, null with
+    orjson, rejected by ujson and not standard with json.
+
+    Args:
+        app (Flask, optional): application to initialize
+
+    Attributes:
+        name (str): library in use, one of ENCODERS
+    """
+
+    def __init__(self, app=None):
+        self.name = None
+        self._dumps = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Load library from WIIM_JSON_ENCODER, None tries all ENCODERS
+
+        Raises:
+            ImportError: If configured library is not installed
+        """
+        names = [app.config['WIIM_JSON_ENCODER']] if app.config['WIIM_JSON_ENCODER'] \
+            else ENCODERS
+
+        for name in names:
+            try:
+                self._dumps = getattr(self, '_load_' + name)(app)
+            except ImportError:
+                if name == names[-1]:
+                    raise
+                continue
+
+            self.name = name
+            break
+
+        app.extensions['json_provider'] = self
+
+    @staticmethod
+    def pretty(app):
+        """ Check if output has indentation, WIIM_JSON_COMPACT None follows Flask """
+        if app.config['WIIM_JSON_COMPACT'] is None:
+            return app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug
+
+        return not app.config['WIIM_JSON_COMPACT']
+
+    def _load_orjson(self, app):
+        import orjson
+
+        # keys that are not strings converted like json
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+        if app.config['JSON_SORT_KEYS']:
+            option |= orjson.OPT_SORT_KEYS
+        if self.pretty(app):
+            option |= orjson.OPT_INDENT_2
+
+        # orjson has no ensure_ascii, always outputs UTF-8
+        if app.config['JSON_AS_ASCII']:
+            return lambda obj: ascii_escape(
+                orjson.dumps(obj, default=default, option=option).decode())
+
+        return lambda obj: orjson.dumps(obj, default=default, option=option).decode()
+
+    def _load_ujson(self, app):
+        import ujson
+
+        kwargs = {
+            'sort_keys': app.config['JSON_SORT_KEYS'],
+            'ensure_ascii': app.config['JSON_AS_ASCII'],
+            'indent': 2 if self.pretty(app) else 0,
+            'escape_forward_slashes': False,
+            'default': default,
+        }
+
+        return lambda obj: ujson.dumps(obj, **kwargs)
+
+    def _load_json(self, app):
+        kwargs = {
+            'sort_keys': app.config['JSON_SORT_KEYS'],
+            'ensure_ascii': app.config['JSON_AS_ASCII'],
+            'default': default,
+        }
+        if self.pretty(app):
+            # no trailing spaces, like the other libraries
+            kwargs.update(indent=2, separators=(',', ': '))
+        else:
+            kwargs.update(separators=(',', ':'))
+
+        return lambda obj: json.dumps(obj, **kwargs)
+
+    def dumps(self, obj):
+        """ Serialize obj to JSON string """
+        return self._dumps(obj)
+
+    def response(self, *args, **kwargs):
+        """ Create JSON response like flask jsonify """
+        if args and kwargs:
+            raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+
+        data = args[0] if len(args) == 1 else args or kwargs
+
+        return current_app.response_class(
+            self.dumps(data) + '\n',
+            mimetype=current_app.config['JSONIFY_MIMETYPE']
+        )
+
+
+def jsonify(*args, **kwargs):
+    """ Create JSON response with the encoder of current application """
+    return current_app.extensions['json_provider'].response(*args, **kwargs)
@@ -1,6 +1,8 @@
 ﻿CREATE TABLE `server` (
   `id` INTEGER PRIMARY KEY AUTO_INCREMENT,
-  `uid` VARCHAR(64) NOT NULL
+  `uid` VARCHAR(64) NOT NULL,
+  `endpoint` VARCHAR(255),
+  `retention` INTEGER
 )
 CHARACTER SET 'utf8' 
 COLLATE 'utf8_unicode_ci';
@@ -15,71 +17,123 @@ COLLATE 'utf8_unicode_ci';
 
 CREATE TABLE `tag` (
   `id` INTEGER PRIMARY KEY AUTO_INCREMENT,
-  `server` INTEGER NOT NULL,
+  `server_id` INTEGER NOT NULL,
   `name` VARCHAR(64) NOT NULL,
-  `alias` VARCHAR(120) NOT NULL,
-  `unit` VARCHAR(64) NOT NULL,
-  `comment` VARCHAR(120) NOT NULL,
-  `icon` VARCHAR(255) NOT NULL
+  `alias` VARCHAR(64) NOT NULL,
+  `unit` VARCHAR(64),
+  `comment` VARCHAR(120),
+  `icon` VARCHAR(255),
+  `node_id` VARCHAR(255),
+  `retention` INTEGER,
+  `data_type` VARCHAR(8) NOT NULL DEFAULT 'double',
+  `deadband` DOUBLE,
+  `deadband_type` VARCHAR(8) NOT NULL DEFAULT 'absolute',
+  `heartbeat` INTEGER,
+  `compression` DOUBLE
 )
 CHARACTER SET 'utf8' 
 COLLATE 'utf8_unicode_ci';
 
-CREATE INDEX `idx_tag__server` ON `tag` (`server`);
+CREATE INDEX `idx_tag__server` ON `tag` (`server_id`);
 
-ALTER TABLE `tag` ADD CONSTRAINT `fk_tag__server` FOREIGN KEY (`server`) REFERENCES `server` (`id`);
+ALTER TABLE `tag` ADD CONSTRAINT `fk_tag__server` FOREIGN KEY (`server_id`) REFERENCES `server` (`id`);
 
 CREATE TABLE `record` (
-  `id` INTEGER PRIMARY KEY AUTO_INCREMENT,
-  `tag` INTEGER NOT NULL,
-  `time_opc` DATETIME(3),
-  `time_db` TIMESTAMP(3),
-  `value` VARCHAR(120) NOT NULL,
-  `quality` VARCHAR(64) NOT NULL
-) engine = MyISAM 
+  `id` INTEGER AUTO_INCREMENT,
+  `tag_id` INTEGER NOT NULL,
+  `time_opc` DATETIME(3) NOT NULL,
+  `time_db` TIMESTAMP(3) NOT NULL,
+  `value_double` DOUBLE,
+  `value_int` BIGINT,
+  `value_bool` BOOL,
+  `value_text` VARCHAR(120),
+  `quality` SMALLINT NOT NULL,
+  CONSTRAINT `pk_record` PRIMARY KEY (`id`, `time_opc`)
+) engine = InnoDB 
 CHARACTER SET 'utf8' 
-COLLATE 'utf8_unicode_ci';
+COLLATE 'utf8_unicode_ci'
+PARTITION BY RANGE COLUMNS(`time_opc`) (
+  PARTITION pmax VALUES LESS THAN (MAXVALUE)
+);
 
-CREATE INDEX `idx_record__tag` ON `record` (`tag`);
+CREATE INDEX `idx_record__tag_time` ON `record` (`tag_id`, `time_opc`, `id`);
 
-ALTER TABLE `record` ADD CONSTRAINT `fk_record__tag` FOREIGN KEY (`tag`) REFERENCES `tag` (`id`);
+CREATE INDEX `idx_record__time` ON `record` (`time_opc`);
 
 CREATE TABLE `zone` (
   `id` INTEGER PRIMARY KEY AUTO_INCREMENT,
-  `site` INTEGER NOT NULL,
+  `site_id` INTEGER NOT NULL,
   `name` VARCHAR(64) NOT NULL,
   `comment` VARCHAR(120) NOT NULL
 )
 CHARACTER SET 'utf8' 
 COLLATE 'utf8_unicode_ci';
 
-CREATE INDEX `idx_zone__site` ON `zone` (`site`);
+CREATE INDEX `idx_zone__site` ON `zone` (`site_id`);
 
-ALTER TABLE `zone` ADD CONSTRAINT `fk_zone__site` FOREIGN KEY (`site`) REFERENCES `site` (`id`);
+ALTER TABLE `zone` ADD CONSTRAINT `fk_zone__site` FOREIGN KEY (`site_id`) REFERENCES `site` (`id`);
 
 CREATE TABLE `process` (
   `id` INTEGER PRIMARY KEY AUTO_INCREMENT,
-  `zone` INTEGER NOT NULL,
+  `zone_id` INTEGER NOT NULL,
   `name` VARCHAR(64) NOT NULL,
-  `comment` VARCHAR(120) NOT NULL
+  `comment` VARCHAR(120)
 )
 CHARACTER SET 'utf8' 
 COLLATE 'utf8_unicode_ci';
 
-CREATE INDEX `idx_process__zone` ON `process` (`zone`);
+CREATE INDEX `idx_process__zone` ON `process` (`zone_id`);
 
-ALTER TABLE `process` ADD CONSTRAINT `fk_process__zone` FOREIGN KEY (`zone`) REFERENCES `zone` (`id`);
+ALTER TABLE `process` ADD CONSTRAINT `fk_process__zone` FOREIGN KEY (`zone_id`) REFERENCES `zone` (`id`);
 
 CREATE TABLE `process_tags` (
-  `tag` INTEGER NOT NULL,
-  `process` INTEGER NOT NULL,
-  CONSTRAINT `pk_process_tags` PRIMARY KEY (`tag`, `process`)
+  `process_id` INTEGER NOT NULL,
+  `tag_id` INTEGER NOT NULL,
+  CONSTRAINT `pk_process_tags` PRIMARY KEY (`process_id`, `tag_id`)
 )
 CHARACTER SET 'utf8' 
 COLLATE 'utf8_unicode_ci';
 
-CREATE INDEX `idx_process_tags` ON `process_tags` (`process`);
+CREATE INDEX `idx_process_tags__tag` ON `process_tags` (`tag_id`, `process_id`);
+
+ALTER TABLE `process_tags` ADD CONSTRAINT `fk_process_tags__process` FOREIGN KEY (`process_id`) REFERENCES `process` (`id`);
+
+ALTER TABLE `process_tags` ADD CONSTRAINT `fk_process_tags__tag` FOREIGN KEY (`tag_id`) REFERENCES `tag` (`id`);
+
+CREATE TABLE `tag_latest` (
+  `tag_id` INTEGER PRIMARY KEY,
+  `record_id` INTEGER NOT NULL,
+  `time_opc` DATETIME(3) NOT NULL
+)
+CHARACTER SET 'utf8' 
+COLLATE 'utf8_unicode_ci';
 
-ALTER TABLE `process_tags` ADD CONSTRAINT `fk_process_tags__process` FOREIGN KEY (`process`) REFERENCES `process` (`id`);
+ALTER TABLE `tag_latest` ADD CONSTRAINT `fk_tag_latest__tag` FOREIGN KEY (`tag_id`) REFERENCES `tag` (`id`) ON DELETE CASCADE;
+
+CREATE TABLE `record_rollup` (
+  `tag_id` INTEGER NOT NULL,
+  `resolution` INTEGER NOT NULL,
+  `bucket` DATETIME NOT NULL,
+  `count` INTEGER NOT NULL,
+  `sum` DOUBLE NOT NULL,
+  `min` DOUBLE NOT NULL,
+  `max` DOUBLE NOT NULL,
+  `first` DOUBLE NOT NULL,
+  `last` DOUBLE NOT NULL,
+  CONSTRAINT `pk_record_rollup` PRIMARY KEY (`tag_id`, `resolution`, `bucket`)
+)
+CHARACTER SET 'utf8' 
+COLLATE 'utf8_unicode_ci';
+
+ALTER TABLE `record_rollup` ADD CONSTRAINT `fk_record_rollup__tag` FOREIGN KEY (`tag_id`) REFERENCES `tag` (`id`) ON DELETE CASCADE;
+
+CREATE TABLE `rollup_pending` (
+  `tag_id` INTEGER PRIMARY KEY,
+  `time_start` DATETIME(3) NOT NULL,
+  `time_end` DATETIME(3) NOT NULL,
+  `version` INTEGER NOT NULL DEFAULT 0
+)
+CHARACTER SET 'utf8' 
+COLLATE 'utf8_unicode_ci';
 
-ALTER TABLE `process_tags` ADD CONSTRAINT `fk_process_tags__tag` FOREIGN KEY (`tag`) REFERENCES `tag` (`id`)
\ No newline at end of file
+ALTER TABLE `rollup_pending` ADD CONSTRAINT `fk_rollup_pending__tag` FOREIGN KEY (`tag_id`) REFERENCES `tag` (`id`) ON DELETE CASCADE
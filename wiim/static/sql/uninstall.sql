@@ -1,5 +1,5 @@
 ﻿SET FOREIGN_KEY_CHECKS = 0;
 
-DROP TABLE IF EXISTS `server`, `site`, `tag`, `record`, `zone`, `process`, `process_tags`;
+DROP TABLE IF EXISTS `server`, `site`, `tag`, `record`, `zone`, `process`, `process_tags`, `tag_latest`, `record_rollup`;
 
 SET FOREIGN_KEY_CHECKS = 1;
\ No newline at end of file